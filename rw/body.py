@@ -0,0 +1,358 @@
+# Copyright 2015 Florian Ludwig
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Request body handling
+
+Routes declared with ``stream=True`` are called as soon as the request
+headers arrived and receive the body chunk by chunk from the injected
+``body_stream``::
+
+    @mod.post('/upload', stream=True, max_body_size=2 * 1024 ** 3)
+    @gen.coroutine
+    def upload(handler, body_stream):
+        with open('/tmp/upload', 'wb') as f:
+            while True:
+                chunk = yield body_stream.read()
+                if not chunk:
+                    break
+                f.write(chunk)
+        handler.finish('done')
+
+Other request bodies are collected by a `SpooledBody`, which moves them
+to a temporary file once they grow beyond ``rw.http: spool_threshold``
+bytes (1 MiB by default, 0 disables spooling).  The file is available as
+``request.body_file``.  ``multipart/form-data`` bodies are parsed while
+they arrive by `MultipartParser` instead, uploaded files end up in
+``request.files`` as `UploadedFile` objects backed by temporary files.
+Their raw ``request.body`` is only kept up to the spool threshold, it is
+``b''`` for larger ones::
+
+    rw.http:
+      spool_threshold: 1048576
+      spool_dir: /var/tmp
+"""
+from __future__ import absolute_import, division, print_function, with_statement
+
+import tempfile
+
+from tornado import concurrent
+from tornado import gen
+from tornado import httputil
+from tornado import iostream
+from tornado import queues
+from tornado.log import gen_log
+
+
+DEFAULT_SPOOL_THRESHOLD = 1024 * 1024
+
+
+class BodyStream(object):
+    """Chunks of a request body in the order they are received
+
+    At most `maxsize` chunks are buffered, after that tornado stops
+    reading from the connection until the consumer catches up.
+    """
+    def __init__(self, maxsize=16):
+        self._queue = queues.Queue(maxsize)
+        self._complete = False
+        self._aborted = False
+
+    def feed(self, chunk):
+        """Add `chunk`, returns a Future resolving once there is space"""
+        if self._aborted:
+            # nobody reads the rest of the body, let tornado discard it
+            future = concurrent.Future()
+            future.set_result(None)
+            return future
+        return self._queue.put(chunk)
+
+    def close(self):
+        """Mark the end of the body"""
+        self._complete = True
+        self._queue.put(None)
+
+    def abort(self):
+        """Stop receiving an incomplete body
+
+        Either the connection was closed or the response was finished
+        before the body was read.  Buffered chunks are dropped and
+        pending `feed` calls resolved, so the connection does not wait
+        for a reader anymore.
+        """
+        if self._complete:
+            return
+        self._aborted = True
+        while not self._queue.empty():
+            # also moves the chunks of waiting feed calls into the queue
+            self._queue.get_nowait()
+        # wake up a waiting reader
+        self._queue.put_nowait(None)
+
+    @gen.coroutine
+    def read(self):
+        """Next chunk of the body, ``b''`` once the body is complete
+
+        :raise tornado.iostream.StreamClosedError: if the connection
+            was closed before the body was complete
+        """
+        if self._aborted and self._queue.empty():
+            raise iostream.StreamClosedError()
+        chunk = yield self._queue.get()
+        if chunk is None:
+            if self._aborted:
+                raise iostream.StreamClosedError()
+            # keep returning the end of the body on further reads
+            self._queue.put_nowait(None)
+            raise gen.Return(b'')
+        raise gen.Return(chunk)
+
+
+def create_reader(request, settings):
+    """`MultipartParser` or `SpooledBody` for the body of `request`
+
+    :param dict settings: the ``rw.http`` settings
+    """
+    threshold = settings.get('spool_threshold', DEFAULT_SPOOL_THRESHOLD)
+    spool_dir = settings.get('spool_dir')
+    content_type = request.headers.get('Content-Type', '')
+    if content_type.startswith('multipart/form-data') and \
+            'Content-Encoding' not in request.headers:
+        for field in content_type.split(';'):
+            key, _, value = field.strip().partition('=')
+            if key == 'boundary' and value:
+                return MultipartParser(httputil.utf8(value), threshold, spool_dir)
+    return SpooledBody(threshold, spool_dir)
+
+
+def _spool(threshold, spool_dir):
+    return tempfile.SpooledTemporaryFile(max_size=threshold, dir=spool_dir)
+
+
+class SpooledBody(object):
+    """Request body kept in memory up to `threshold` bytes, then on disk
+
+    :param int threshold: bytes to keep in memory, 0 to never spool
+    :param str spool_dir: directory for temporary files
+    """
+    def __init__(self, threshold=DEFAULT_SPOOL_THRESHOLD, spool_dir=None):
+        self.threshold = threshold
+        self.spool_dir = spool_dir
+        self.size = 0
+        self.file = None
+        self._chunks = []
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.file is not None:
+            self.file.write(chunk)
+        elif self.threshold and self.size > self.threshold:
+            self.file = tempfile.TemporaryFile(dir=self.spool_dir)
+            for buffered in self._chunks:
+                self.file.write(buffered)
+            self.file.write(chunk)
+            self._chunks = None
+        else:
+            self._chunks.append(chunk)
+
+    def finish(self, request):
+        """Store the body in `request`
+
+        Spooled bodies are available as ``request.body_file``,
+        `rw.httpbase.Request` reads them into ``request.body`` on
+        first access.
+        """
+        if self.file is not None:
+            self.file.seek(0)
+            request.body_file = self.file
+        else:
+            request.body_file = None
+            request.body = b''.join(self._chunks)
+        request._parse_body()
+
+
+class UploadedFile(httputil.HTTPFile):
+    """`tornado.httputil.HTTPFile` with the content in a temporary file
+
+    Keys: ``filename``, ``content_type`` and ``file``.  The ``body``
+    attribute and key read the whole content for compatibility.
+    """
+    @property
+    def body(self):
+        self.file.seek(0)
+        body = self.file.read()
+        self.file.seek(0)
+        return body
+
+    def __getitem__(self, key):
+        if key == 'body':
+            return self.body
+        return super(UploadedFile, self).__getitem__(key)
+
+    def __contains__(self, key):
+        return key == 'body' or super(UploadedFile, self).__contains__(key)
+
+    def get(self, key, default=None):
+        if key == 'body':
+            return self.body
+        return super(UploadedFile, self).get(key, default)
+
+
+class MultipartParser(object):
+    """Incremental ``multipart/form-data`` parser
+
+    Field values are collected in memory, file contents are written to
+    a `tempfile.SpooledTemporaryFile` each.  The raw body is kept as
+    well as long as it does not exceed `threshold`.
+    """
+    def __init__(self, boundary, threshold=DEFAULT_SPOOL_THRESHOLD, spool_dir=None):
+        if boundary.startswith(b'"') and boundary.endswith(b'"'):
+            boundary = boundary[1:-1]
+        self.threshold = threshold
+        self.spool_dir = spool_dir
+        self.arguments = {}
+        self.files = {}
+        # a delimiter is always preceded by CRLF, except for the first
+        # one which we treat the same by starting the buffer with CRLF
+        self._delimiter = b'\r\n--' + boundary
+        self._buffer = bytearray(b'\r\n')
+        self._state = 'preamble'
+        self._part = None  # (name, value bytearray or UploadedFile)
+        self.size = 0
+        self._chunks = []  # the raw body, None once above the threshold
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self._chunks is not None:
+            if self.threshold and self.size > self.threshold:
+                self._chunks = None
+            else:
+                self._chunks.append(chunk)
+        self._buffer += chunk
+        while self._parse():
+            pass
+
+    def _parse(self):
+        """Consume as much of the buffer as possible in the current state
+
+        :return bool: True if the state changed and parsing can continue
+        """
+        buf = self._buffer
+        if self._state == 'preamble':
+            index = buf.find(self._delimiter)
+            if index == -1:
+                # keep what might be the beginning of the delimiter
+                del buf[:max(0, len(buf) - len(self._delimiter))]
+                return False
+            del buf[:index + len(self._delimiter)]
+            self._state = 'delimiter'
+            return True
+        elif self._state == 'delimiter':
+            if len(buf) < 2:
+                return False
+            if buf[:2] == b'--':
+                self._state = 'epilogue'
+                del buf[:]
+                return False
+            end = buf.find(b'\r\n')
+            if end == -1:
+                return False
+            # ignore transport padding after the delimiter
+            del buf[:end + 2]
+            self._state = 'headers'
+            return True
+        elif self._state == 'headers':
+            if buf[:2] == b'\r\n':
+                # part without headers
+                end = -2
+            else:
+                end = buf.find(b'\r\n\r\n')
+                if end == -1:
+                    return False
+            try:
+                headers = httputil.HTTPHeaders.parse(bytes(buf[:max(0, end)]).decode('utf-8'))
+            except Exception as e:
+                # like tornado.httputil.parse_body_arguments: log and
+                # keep the fields parsed so far, ignore the rest
+                gen_log.warning('Invalid multipart/form-data: %s', e)
+                self._state = 'epilogue'
+                del buf[:]
+                return False
+            del buf[:end + 4]
+            self._start_part(headers)
+            self._state = 'data'
+            return True
+        elif self._state == 'data':
+            index = buf.find(self._delimiter)
+            if index == -1:
+                # write all data that cannot be part of the delimiter
+                keep = len(self._delimiter) - 1
+                if len(buf) > keep:
+                    self._write(buf[:len(buf) - keep])
+                    del buf[:len(buf) - keep]
+                return False
+            self._write(buf[:index])
+            del buf[:index + len(self._delimiter)]
+            self._end_part()
+            self._state = 'delimiter'
+            return True
+        else:  # epilogue
+            del buf[:]
+            return False
+
+    def _start_part(self, headers):
+        disposition, params = httputil._parse_header(headers.get('Content-Disposition', ''))
+        name = params.get('name')
+        if disposition != 'form-data' or not name:
+            gen_log.warning('Invalid multipart/form-data part')
+            self._part = None
+        elif params.get('filename'):
+            upload = UploadedFile(filename=params['filename'],
+                                  content_type=headers.get('Content-Type', 'application/unknown'),
+                                  file=_spool(self.threshold, self.spool_dir))
+            self._part = name, upload
+        else:
+            self._part = name, bytearray()
+
+    def _write(self, data):
+        if self._part is None:
+            return
+        value = self._part[1]
+        if isinstance(value, UploadedFile):
+            value.file.write(data)
+        else:
+            value += data
+
+    def _end_part(self):
+        if self._part is None:
+            return
+        name, value = self._part
+        self._part = None
+        if isinstance(value, UploadedFile):
+            value.file.seek(0)
+            self.files.setdefault(name, []).append(value)
+        else:
+            self.arguments.setdefault(name, []).append(bytes(value))
+
+    def finish(self, request):
+        """Store the parsed arguments and files in `request`"""
+        if self._state != 'epilogue':
+            gen_log.warning('Invalid multipart/form-data: no final boundary')
+        request.body_file = None
+        if self._chunks is not None:
+            request.body = b''.join(self._chunks)
+        for name, values in self.arguments.items():
+            request.body_arguments.setdefault(name, []).extend(values)
+            request.arguments.setdefault(name, []).extend(values)
+        for name, files in self.files.items():
+            request.files.setdefault(name, []).extend(files)
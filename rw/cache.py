@@ -0,0 +1,229 @@
+# Copyright 2015 Florian Ludwig
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In-process response cache for `rw.http.Module` routes
+
+Example usage::
+
+    @mod.get('/feed', cache=60)
+    def feed():
+        ...
+
+    @mod.get('/news', cache={'ttl': 300, 'vary': ['Accept-Language']})
+    def news():
+        ...
+
+Concurrent identical requests can also be coalesced into one handler
+execution without caching the response (see `Coalescer`)::
+
+    @mod.get('/popular', coalesce=True)
+    def popular():
+        ...
+
+Size limits are configured in the ``rw.http`` section::
+
+    rw.http:
+      response_cache:
+        max_bytes: 67108864
+
+The ETag of responses is computed according to the ``etag`` setting of
+``rw.http`` or the ``etag`` route option, see `ETAG_STRATEGIES`::
+
+    @mod.get('/report', etag='fast')
+    def report():
+        ...
+"""
+from __future__ import absolute_import, division, print_function, with_statement
+
+import time
+import zlib
+import hashlib
+import collections
+
+from tornado import util
+from tornado.concurrent import Future
+
+
+class CachePolicy(object):
+    """How responses of a route are cached
+
+    :param float ttl: seconds a response is served from cache
+    :param list vary: request headers that are part of the cache key
+    :param bool query: include the query string in the cache key
+    """
+    def __init__(self, ttl=60, vary=(), query=True):
+        self.ttl = ttl
+        self.vary = tuple(vary)
+        self.query = query
+
+    @classmethod
+    def create(cls, option):
+        """Create policy from the ``cache`` or ``coalesce`` route option
+
+        :param option: `CachePolicy`, ttl in seconds, dict of
+                       arguments or True for defaults
+        :return CachePolicy: policy or None if caching is disabled
+        """
+        if option is None or option is False:
+            return None
+        if isinstance(option, CachePolicy):
+            return option
+        if option is True:
+            return cls()
+        if isinstance(option, dict):
+            return cls(**option)
+        return cls(ttl=option)
+
+    def key(self, request):
+        """cache key of `request`"""
+        query = request.query if self.query else ''
+        headers = tuple(request.headers.get(header) for header in self.vary)
+        return request.path, query, headers
+
+
+class CacheEntry(object):
+    def __init__(self, status_code, headers, body, expires):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+        self.size = len(body) + sum(len(name) + len(util.unicode_type(value))
+                                    for name, value in headers.get_all())
+
+
+class ResponseCache(object):
+    """LRU cache of finished responses, bounded by their total size in bytes"""
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key):
+        """Return the `CacheEntry` stored for `key` or None"""
+        try:
+            entry = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        if entry.expires < time.time():
+            self.size -= entry.size
+            self.misses += 1
+            return None
+        # re-insert to mark as most recently used
+        self._data[key] = entry
+        self.hits += 1
+        return entry
+
+    def put(self, key, status_code, headers, body, ttl):
+        entry = CacheEntry(status_code, headers, body, time.time() + ttl)
+        if entry.size > self.max_bytes:
+            return
+        self.discard(key)
+        self._data[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self.size -= evicted.size
+
+    def discard(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+class Coalescer(object):
+    """Single-flight execution of identical concurrent requests
+
+    The first request for a key (the leader) runs the handler,
+    all requests for the same key arriving meanwhile wait for
+    its response instead of running the handler themselves.
+    """
+    def __init__(self):
+        self.coalesced = 0
+        self._in_flight = {}
+
+    def join(self, key):
+        """Wait for the response of the request in flight for `key`
+
+        :return: Future resolving to ``(status_code, headers, body)`` or
+                 None if there is no request in flight.  In that case the
+                 caller is the leader and must call `resolve` once done.
+        """
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return future
+        self._in_flight[key] = Future()
+        return None
+
+    def resolve(self, key, status_code, headers, body):
+        future = self._in_flight.pop(key, None)
+        if future is not None:
+            future.set_result((status_code, headers, body))
+
+    def __len__(self):
+        return len(self._in_flight)
+
+
+def etag_sha1(parts):
+    """Strong ETag from the SHA1 hash of the body (tornado's default)"""
+    hasher = hashlib.sha1()
+    for part in parts:
+        hasher.update(part)
+    return '"%s"' % hasher.hexdigest()
+
+
+def etag_fast(parts):
+    """Strong ETag from the length and CRC32 checksum of the body"""
+    crc = 0
+    length = 0
+    for part in parts:
+        crc = zlib.crc32(part, crc)
+        length += len(part)
+    return '"%x-%08x"' % (length, crc & 0xffffffff)
+
+
+def etag_version(version):
+    """Weak ETag for an application supplied `version`"""
+    return 'W/"%s"' % version
+
+
+#: strategies to compute an ETag from the response body parts.
+#: ``version`` only uses versions supplied by the handler (see
+#: `rw.httpbase.RequestHandler.check_version`) or the ``etag_version``
+#: setting of ``rw.http``.  Instead of a name a callable taking the
+#: request handler and returning the ETag or None can be given.
+ETAG_STRATEGIES = {
+    'sha1': etag_sha1,
+    'fast': etag_fast,
+    'version': None,
+    'off': None,
+}
+
+
+def check_etag_strategy(strategy):
+    """Raise ValueError if `strategy` is not a known ETag strategy"""
+    if strategy is not None and not callable(strategy) and strategy not in ETAG_STRATEGIES:
+        raise ValueError('Unknown ETag strategy {!r}, use one of {}'.format(
+            strategy, ', '.join(sorted(ETAG_STRATEGIES))))
+    return strategy
@@ -37,19 +37,46 @@ class Event(set):
 
     @gen.coroutine
     def __call__(self, *args, **kwargs):
+        re = self.fire(*args, **kwargs)
+        if isinstance(re, gen.Future):
+            re = yield re
+        raise gen.Return(re)
+
+    def fire(self, *args, **kwargs):
+        """Call all listeners without the overhead of a coroutine
+
+        :return: the (accumulated) results if all listeners returned
+                 synchronously, otherwise a Future resolving to them.
+                 Exceptions of synchronous listeners are raised directly.
+        """
+        if not self:
+            return self.accumulator([]) if self.accumulator else []
+
         re = []
-        futures = []
+        futures = None
         for func in self:
             result = func(*args, **kwargs)
             if isinstance(result, gen.Future):
                 # we are not waiting for future objects result here
                 # so they evaluate in parallel
-                futures.append((func, result))
+                if futures is None:
+                    futures = []
+                futures.append(result)
             else:
                 re.append(result)
 
+        if futures is not None:
+            return self._wait(re, futures)
+
+        # apply accumulator
+        if self.accumulator:
+            re = self.accumulator(re)
+        return re
+
+    @gen.coroutine
+    def _wait(self, re, futures):
         # wait for results
-        for func, future in futures:
+        for future in futures:
             if not future.done():
                 yield future
             re.append(future.result())
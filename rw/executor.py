@@ -0,0 +1,216 @@
+# Copyright 2015 Florian Ludwig
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Run blocking code in a thread pool without losing `rw.scope`
+
+Route functions can be run in the pool as a whole::
+
+    @mod.get('/report', executor=True)
+    def report(db):
+        return db.blocking_query()
+
+or offload single calls using the injectable ``executor``::
+
+    @mod.get('/report')
+    @gen.coroutine
+    def report(handler, executor, db):
+        result = yield executor.submit(db.blocking_query)
+        handler.finish(result)
+
+Code running inside the pool must not call methods of the request
+handler, return the response body instead.
+
+The pool is created on first use and configured in the
+``rw.executor`` section::
+
+    rw.executor:
+      max_workers: 8
+      queue: 100
+
+CPU bound code is better run in the `ProcessPool`, either for whole
+routes or using the injectable ``process_pool``::
+
+    @mod.get('/thumbnail/<name>', process=True)
+    def thumbnail(name):
+        return render_thumbnail(name)
+
+Only the url variables are passed to route functions running in the
+process pool, there is no scope inside the worker processes.  Such route
+functions must be defined at module level and must not take injected
+arguments, see `check_process_route`.  The pool
+is started during `rw.server.PHASE_SETUP` if the ``rw.process_pool``
+section is present, otherwise on first use::
+
+    rw.process_pool:
+      max_workers: 4
+      warm_up: true
+"""
+from __future__ import absolute_import, division, print_function, with_statement
+
+import sys
+import threading
+import multiprocessing
+
+from concurrent import futures
+
+import rw.gen
+import rw.scope
+
+
+class QueueFull(Exception):
+    """Raised by `ScopedExecutor.submit` if too many calls are waiting"""
+
+
+class ScopedExecutor(object):
+    """`concurrent.futures.ThreadPoolExecutor` running calls inside the current scope
+
+    :param int max_workers: number of threads
+    :param int queue: maximum number of calls waiting for a free thread,
+                      0 for no limit
+    """
+    def __init__(self, max_workers=4, queue=0):
+        self.max_workers = max_workers
+        self.queue = queue
+        self.queued = 0
+        self.busy = 0
+        self.completed = 0
+        self._lock = threading.Lock()
+        self._pool = futures.ThreadPoolExecutor(max_workers)
+
+    def submit(self, fn, *args, **kwargs):
+        """Call ``fn(*args, **kwargs)`` in the pool
+
+        :return concurrent.futures.Future: result of the call
+        :raise QueueFull: if `queue` calls are already waiting
+        """
+        with self._lock:
+            if self.queue and self.queued >= self.queue:
+                raise QueueFull()
+            self.queued += 1
+        chain = rw.scope.get_chain()
+        return self._pool.submit(self._run, chain, fn, args, kwargs)
+
+    def _run(self, chain, fn, args, kwargs):
+        with self._lock:
+            self.queued -= 1
+            self.busy += 1
+        try:
+            with rw.scope.chain_context(chain):
+                return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.busy -= 1
+                self.completed += 1
+
+    def stats(self):
+        return {
+            'max_workers': self.max_workers,
+            'queued': self.queued,
+            'busy': self.busy,
+            'completed': self.completed,
+        }
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait)
+
+
+class ProcessPool(object):
+    """Lazily started `concurrent.futures.ProcessPoolExecutor`
+
+    Functions and arguments passed to `submit` must be picklable.
+
+    :param int max_workers: number of processes, defaults to the
+                            number of CPUs
+    :param bool warm_up: fork all worker processes on `start` instead
+                         of on first use
+    """
+    def __init__(self, max_workers=None, warm_up=True):
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.warm_up = warm_up
+        self._pool = None
+
+    @rw.gen.coroutine
+    def start(self):
+        if self._pool is not None:
+            return
+        self._pool = futures.ProcessPoolExecutor(self.max_workers)
+        if self.warm_up:
+            yield [self._pool.submit(_noop) for _ in range(self.max_workers)]
+
+    def submit(self, fn, *args, **kwargs):
+        """Call ``fn(*args, **kwargs)`` in a worker process
+
+        :return concurrent.futures.Future: result of the call
+        """
+        if self._pool is None:
+            self._pool = futures.ProcessPoolExecutor(self.max_workers)
+        return self._pool.submit(fn, *args, **kwargs)
+
+    def submit_route(self, call_plan, url_variables):
+        """Run the route function of `call_plan` in a worker process"""
+        fn = call_plan.fn
+        kwargs = dict((arg, url_variables[arg]) for arg in call_plan.url_args)
+        return self.submit(_call_route, fn.__module__, fn.__name__, kwargs)
+
+    def shutdown(self, wait=True):
+        if self._pool is not None:
+            self._pool.shutdown(wait)
+            self._pool = None
+
+
+def _noop():
+    pass
+
+
+def _import_route(module_name, name):
+    # route functions cannot be pickled directly as the module
+    # attribute is the rw.scope.inject wrapper, not the function
+    __import__(module_name)
+    fn = getattr(sys.modules[module_name], name, None)
+    while hasattr(fn, '_rw_injected_function'):
+        fn = fn._rw_injected_function
+    return fn
+
+
+def _call_route(module_name, name, kwargs):
+    return _import_route(module_name, name)(**kwargs)
+
+
+def check_process_route(call_plan):
+    """Raise ValueError if the route function of `call_plan`
+    cannot be run by `ProcessPool.submit_route`
+
+    Worker processes import the function by its module and name and
+    only pass the url variables.
+    """
+    fn = call_plan.fn
+    name = '{}.{}'.format(fn.__module__, fn.__name__)
+    if call_plan.scope_args:
+        raise ValueError('{} runs in the process pool, which only passes url variables, '
+                         'but injects {}'.format(name, ', '.join(call_plan.scope_args)))
+    if fn.__module__ == '__main__' or _import_route(fn.__module__, fn.__name__) is not fn:
+        raise ValueError('{} runs in the process pool but cannot be imported by its name, '
+                         'use a function defined at module level'.format(name))
+
+
+@rw.scope.inject
+def create(settings):
+    """Create `ScopedExecutor` as configured in ``rw.executor``"""
+    return ScopedExecutor(**settings.get('rw.executor', {}))
+
+
+@rw.scope.inject
+def create_process_pool(settings):
+    """Create `ProcessPool` as configured in ``rw.process_pool``"""
+    return ProcessPool(**settings.get('rw.process_pool', {}))
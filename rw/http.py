@@ -3,6 +3,7 @@ import tornado.web
 
 from . import scope
 
+import rw.cache
 import rw.plugin
 import rw.routing
 import rw.template
@@ -15,6 +16,7 @@ class Module(rw.plugin.Plugin):
         self.routes = []
         self.sub_rt = []
         self.sub_request_handler = []
+        self.middleware = []
         self.template_env = None
 
     def activate(self):
@@ -30,6 +32,7 @@ class Module(rw.plugin.Plugin):
         # at module creation as it results in the module
         # itself being imported while getting setup
         routes = rw.routing.RoutingTable(self.name)
+        routes.middleware = tuple(self.middleware)
         for args in self.routes:
             routes.add_route(*args)
 
@@ -41,10 +44,17 @@ class Module(rw.plugin.Plugin):
             routes.add_request_handler(*args)
 
         if top:
-            routes.setup()
             current_scope = scope.get_current_scope()
+            cfg = {}
             if current_scope is not None:
-                current_scope.setdefault('rw.http', {})['routing_table'] = routes
+                cfg = current_scope.get('settings', {}).get('rw.http', {})
+            routes.setup(flatten=cfg.get('flatten_routes', False))
+            routes.enable_cache(cfg.get('dispatch_cache_size', 0))
+            if current_scope is not None:
+                rw_http = current_scope.setdefault('rw.http', {})
+                rw_http['routing_table'] = routes
+                rw_http['response_cache'] = rw.cache.ResponseCache(**cfg.get('response_cache', {}))
+                rw_http['coalescer'] = rw.cache.Coalescer()
         return routes
 
     @scope.inject
@@ -54,15 +64,36 @@ class Module(rw.plugin.Plugin):
         template = template_env.get_template(template_name)
         handler.finish(template.render(**handler))
 
-    def _generate_decorator(self, method, path):
+    def add_middleware(self, fn):
+        """Run `fn` around all routes of this module and mounted modules
+
+        Example usage::
+
+            @mod.add_middleware
+            def require_user(call_next, user):
+                if user is None:
+                    raise HTTPError(403)
+                return call_next()
+
+        See `rw.routing.run_middleware`.  Middleware of a single route
+        is given using the ``middleware`` route option.
+        """
+        fn = scope.inject(fn)
+        self.middleware.append(fn)
+        return fn
+
+    def _generate_decorator(self, method, path, options):
+        if 'middleware' in options:
+            options['middleware'] = tuple(scope.inject(mw) for mw in options['middleware'])
+
         def decorator(fn):
             fn = scope.inject(fn)
-            fn.rw_route = self.routes.append((method, path, self, fn))
+            fn.rw_route = self.routes.append((method, path, self, fn, options))
             return fn
 
         return decorator
 
-    def get(self, path):
+    def get(self, path, **options):
         """Expose a function for HTTP GET requests
 
         Example usage::
@@ -70,11 +101,31 @@ class Module(rw.plugin.Plugin):
             @mod.get('/')
             def index(handler):
                 ...
+
+        Supported options:
+
+         * ``cache``: serve responses from `rw.cache.ResponseCache`,
+           see `rw.cache.CachePolicy.create`
+         * ``coalesce``: identical concurrent requests share one handler
+           execution, see `rw.cache.Coalescer`
+         * ``etag``: how the ETag is computed, overrides the ``etag``
+           setting of ``rw.http``, see `rw.cache.ETAG_STRATEGIES`
+         * ``executor``: run the function inside the thread pool of
+           `rw.executor` (all methods support this option)
+         * ``process``: run the function inside `rw.executor.ProcessPool`
+         * ``middleware``: list of middleware to run around this route
+           (all methods support this option), see `add_middleware`
+         * ``max_body_size``: requests announcing a larger Content-Length
+           are answered with 413 without reading the body (all methods
+           support this option), defaults to ``rw.http: max_body_size``
+         * ``stream``: call the function before the body is received
+           and inject the ``body_stream``, see `rw.body`.  True or the
+           number of chunks to buffer (all methods support this option)
         """
 
-        return self._generate_decorator('get', path)
+        return self._generate_decorator('get', path, options)
 
-    def post(self, path):
+    def post(self, path, **options):
         """Expose a function for HTTP POST requests
 
         Example usage::
@@ -83,9 +134,9 @@ class Module(rw.plugin.Plugin):
             def save(self):
                 ...
         """
-        return self._generate_decorator('post', path)
+        return self._generate_decorator('post', path, options)
 
-    def put(self, path):
+    def put(self, path, **options):
         """Expose a function for HTTP PUT requests
 
         Example usage::
@@ -94,9 +145,9 @@ class Module(rw.plugin.Plugin):
             def save(self, name):
                 ...
         """
-        return self._generate_decorator('put', path)
+        return self._generate_decorator('put', path, options)
 
-    def delete(self, path):
+    def delete(self, path, **options):
         """Expose a function for HTTP DELETE requests
 
         Example usage::
@@ -105,9 +156,9 @@ class Module(rw.plugin.Plugin):
             def delete(self, name):
                 ...
         """
-        return self._generate_decorator('delete', path)
+        return self._generate_decorator('delete', path, options)
 
-    def options(self, path):
+    def options(self, path, **options):
         """Expose a function for HTTP OPTIONS requests
 
         Example usage::
@@ -116,7 +167,7 @@ class Module(rw.plugin.Plugin):
             def server_options(self, name):
                 ...
         """
-        return self._generate_decorator('options', path)
+        return self._generate_decorator('options', path, options)
 
     def mount(self, path, module, handler_args=None, name=None):
         if handler_args is None:
@@ -129,15 +180,12 @@ class Module(rw.plugin.Plugin):
 
 def url_for(func, **kwargs):
     if isinstance(func, str):
+        routing_table = scope.get('rw.http')['routing_table']
         if func.startswith('.'):
             # relative to current module
-            routing_table = scope.get('rw.http')['routing_table']
-            prefix = scope.get('rw.routing.prefix')
-            path = (prefix + func).lstrip('.')
-            return routing_table.get_path(path, kwargs)
+            return routing_table.get_path(func, kwargs, scope.get('rw.routing.prefix'))
         else:
             # absolute
-            routing_table = scope.get('rw.http')['routing_table']
             return routing_table.get_path(func, kwargs)
     else:
         return func.rw_route.get_path(kwargs)
@@ -14,7 +14,9 @@
 from __future__ import absolute_import, division, print_function, with_statement
 
 import os
-import inspect
+import json
+import time
+import functools
 
 import tornado.web
 import tornado.httpserver
@@ -24,9 +26,13 @@ from tornado import gen
 from tornado import iostream
 from tornado.web import HTTPError
 from tornado.concurrent import is_future
+from tornado.util import PY3
 from tornado.web import _has_stream_request_body
 
+import rw.body
+import rw.cache
 import rw.cfg
+import rw.executor
 import rw.scope
 import rw.routing
 import rw.template
@@ -39,7 +45,7 @@ POST_REQUEST = rw.event.Event('httpbase.post_request')
 
 
 class Application(tornado.httputil.HTTPServerConnectionDelegate):
-    def __init__(self, handler=None, root=None, extra_configs=None):
+    def __init__(self, handler=None, root=None, extra_configs=None, hosts=None):
         """rueckenwind Application to plug into tornado's httpserver.
 
         Either `root` or `handler` must be specified.
@@ -47,13 +53,24 @@ class Application(tornado.httputil.HTTPServerConnectionDelegate):
         :param rw.http.Module root: The root module to serve
         :param handler: The request handler (should subclass `tornado.web.RequestHandler`)
         :param extra_configs: path to alternative config file for rueckenwind
+        :param dict hosts: host name -> `rw.http.Module` to serve for
+                           requests to that host instead of `root`.
+                           Every host gets its own routing table and
+                           template environment, the latter loads
+                           templates of the host module's package
+                           before those of ``rw.templates: pkgs``.
         """
         self.io_loop = tornado.ioloop.IOLoop.current()
         self.settings = {}
         self.rw_settings = {}
         self.root = root
+        self.hosts = dict((host.lower(), module) for host, module in (hosts or {}).items())
+        # host name -> (rw.http, template_env) scope values of that host
+        self.host_values = {}
         self.scope = rw.scope.Scope()
         self.scope['app'] = self
+        self.scope.provider('executor', rw.executor.create)
+        self.scope.provider('process_pool', rw.executor.create_process_pool)
         self.extra_configs = extra_configs
         if self.root:
             self.handler = handler if handler is not None else RequestHandler
@@ -63,6 +80,7 @@ class Application(tornado.httputil.HTTPServerConnectionDelegate):
             pkgs = self.scope['settings'].get('rw.templates', {}).get('pkgs', None)
             if not pkgs:
                 pkgs = [root.name]
+            self.template_pkgs = pkgs
 
             self.scope['template_env'] = rw.template.create_template_env(pkgs)
             self.scope['template_env'].globals['app'] = self
@@ -76,21 +94,45 @@ class Application(tornado.httputil.HTTPServerConnectionDelegate):
         self.ui_modules = {}
         self.ui_methods = {}
         rw.server.PHASE_CONFIGURATION.add(self.configure)
+        rw.server.PHASE_SETUP.add(self.setup)
 
     def configure(self):
         with self.scope():
             return self._scoped_configure()
 
+    def setup(self):
+        with self.scope():
+            if 'rw.process_pool' in self.scope['settings']:
+                return rw.scope.get('process_pool').start()
+
     @gen.coroutine
     def _scoped_configure(self):
         yield rw.scope.setup_app_scope(self.root.name, self.scope)
         self.rw_settings = self.scope['settings']
         cfg_rw_http = self.rw_settings.setdefault('rw.http', {})
         cfg_rw_http['live_settings'] = self.settings
+        rw.cache.check_etag_strategy(cfg_rw_http.get('etag'))
         self._configure_cookie_secret()
 
         yield self.scope.activate(self.root)
 
+        for host, module in self.hosts.items():
+            # activate in a scope of its own so the module
+            # gets its own routing table and template environment
+            host_scope = rw.scope.Scope()
+            host_scope['template_env'] = self._create_host_template_env(module)
+            with host_scope():
+                activation = host_scope.activate(module)
+            yield activation
+            self.host_values[host] = host_scope['rw.http'], host_scope['template_env']
+
+    def _create_host_template_env(self, module):
+        pkgs = [module.name] + [pkg for pkg in self.template_pkgs if pkg != module.name]
+        template_env = rw.template.create_template_env(pkgs)
+        # globals added by plugins and the root module, e.g. static
+        template_env.globals.update(self.scope['template_env'].globals)
+        return template_env
+
     def _configure_cookie_secret(self):
         cfg = self.rw_settings['rw.http']
         if 'cookie_secret' in cfg:
@@ -113,13 +155,79 @@ class Application(tornado.httputil.HTTPServerConnectionDelegate):
         """Called by `tornado.httpserver.HTTPServer` to handle a request."""
         return RequestDispatcher(self, request_conn)
 
+    def _enter_host(self, request_scope, request):
+        """Store the values of the virtual host of `request` in `request_scope`
+
+        The virtual host is looked up once by `_check_request`.
+        """
+        if request.virtual_host is not None:
+            request_scope['rw.http'], request_scope['template_env'] = request.virtual_host
+
+    def _check_request(self, request):
+        """Resolve the route of `request` before its body is read
+
+        The result is stored as ``request.resolved_route`` for
+        `RequestHandler.handle_request`, the scope values of the virtual
+        host as ``request.virtual_host`` for `_enter_host`.
+
+        :return int: status code to reject the request with or None
+        """
+        if not self.root:
+            return None
+        if self.host_values:
+            request.virtual_host = self.host_values.get(request.host_name)
+        if request.virtual_host is not None:
+            rw_http = request.virtual_host[0]
+        else:
+            # Scope.get looks into the current scope chain, not self.scope
+            rw_http = dict.get(self.scope, 'rw.http', {})
+        if 'routing_table' not in rw_http:
+            return None
+        routing_table = rw_http['routing_table']
+        entry, args = None, None
+        if request.method.lower() in routing_table:
+            entry, args = routing_table.resolve(request.method, request.path)
+        request.resolved_route = entry, args
+        if entry is None:
+            allowed_methods = routing_table.allowed_methods(request.path)
+            if allowed_methods:
+                request.allowed_methods = allowed_methods
+                return 405
+            return 404
+
+        max_body_size = self._max_body_size(entry[0])
+        if max_body_size is not None:
+            try:
+                content_length = int(request.headers.get('Content-Length', 0))
+            except ValueError:
+                # tornado rejects the request while reading the body
+                return None
+            if content_length > max_body_size:
+                return 413
+        return None
+
+    def _max_body_size(self, route):
+        """Maximum body size of requests to `route` or None"""
+        if route.max_body_size is not None:
+            return route.max_body_size
+        return self.rw_settings.get('rw.http', {}).get('max_body_size')
+
     @gen.coroutine
     def _handle_request(self, request_scope, request):
+        self._enter_host(request_scope, request)
         handler = self.handler(self, request)
         request_scope['handler'] = handler
-        yield PRE_REQUEST()
-        yield handler._execute([])
-        yield POST_REQUEST()
+        # fire instead of call: no coroutine if listeners are synchronous
+        pre_request = PRE_REQUEST.fire()
+        if is_future(pre_request):
+            yield pre_request
+        try:
+            yield handler._execute([])
+            post_request = POST_REQUEST.fire()
+            if is_future(post_request):
+                yield post_request
+        finally:
+            request._close_files()
 
     def _request_finished(self, request_future):
         # access result to throw exceptions that might have occurred during
@@ -131,57 +239,217 @@ class Application(tornado.httputil.HTTPServerConnectionDelegate):
         pass
 
 
+class Request(tornado.httputil.HTTPServerRequest):
+    """`tornado.httputil.HTTPServerRequest` parsing its body on first use
+
+    Form arguments of the body are parsed once `arguments`,
+    `body_arguments` or `files` is read, the `json` property decodes
+    the body on first access.  Bodies spooled to ``body_file`` (see
+    `rw.body.SpooledBody`) are read back into `body` on first access.
+    The temporary files of the body and of uploads are closed once
+    the request is handled.
+    """
+    def __init__(self, *args, **kwargs):
+        self.body_file = None
+        self.allowed_methods = None  # sent as Allow header, see _check_request
+        self.virtual_host = None  # (rw.http, template_env), see _check_request
+        self._body_pending = False
+        self._json = None
+        super(Request, self).__init__(*args, **kwargs)
+
+    def _parse_body(self):
+        # deferred until the arguments are read
+        self._body_pending = True
+
+    def _parse_pending_body(self):
+        if self._body_pending:
+            self._body_pending = False
+            super(Request, self)._parse_body()
+
+    @property
+    def body(self):
+        if not self._body and self.body_file is not None:
+            self.body_file.seek(0)
+            self._body = self.body_file.read()
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+
+    @property
+    def arguments(self):
+        self._parse_pending_body()
+        return self._arguments
+
+    @arguments.setter
+    def arguments(self, value):
+        self._arguments = value
+
+    @property
+    def body_arguments(self):
+        self._parse_pending_body()
+        return self._body_arguments
+
+    @body_arguments.setter
+    def body_arguments(self, value):
+        self._body_arguments = value
+
+    @property
+    def files(self):
+        self._parse_pending_body()
+        return self._files
+
+    @files.setter
+    def files(self, value):
+        self._files = value
+
+    def _close_files(self):
+        """Close the temporary files of a spooled body and of uploads"""
+        if self.body_file is not None:
+            self.body_file.close()
+        for uploads in self._files.values():
+            for upload in uploads:
+                if isinstance(upload, rw.body.UploadedFile):
+                    upload.file.close()
+
+    @property
+    def json(self):
+        """The body decoded as JSON"""
+        if self._json is None:
+            try:
+                self._json = json.loads(self.body.decode('utf-8'))
+            except ValueError:
+                raise HTTPError(400, 'Invalid JSON body')
+        return self._json
+
+
+def as_bytes(chunk):
+    """Return the response body `chunk` as `bytes`
+
+    Python 2 can neither join nor checksum `memoryview` and
+    `bytearray` chunks, on Python 3 this avoids mixed types.
+    """
+    if isinstance(chunk, memoryview):
+        return chunk.tobytes()
+    if isinstance(chunk, bytearray):
+        return bytes(chunk)
+    return chunk
+
+
+def _announces_body(headers):
+    """True if the request headers announce a non-empty body"""
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        return True
+    try:
+        return int(headers.get('Content-Length', 0)) > 0
+    except ValueError:
+        # tornado rejects the request while reading the body
+        return True
+
+
 class RequestDispatcher(tornado.httputil.HTTPMessageDelegate):
     def __init__(self, application, connection):
         self.application = application
         self.connection = connection
         self.request = None
-        self.chunks = []
         self.handler_class = None
         self.handler_kwargs = None
         self.path_args = []
         self.path_kwargs = {}
         self.stream_request_body = False
+        self.body_stream = None
+        self.body_reader = None  # see rw.body.create_reader
+        self.reject_status = None  # rejected request without body, see finish
 
     def headers_received(self, start_line, headers):
-        self.request = tornado.httputil.HTTPServerRequest(
+        self.request = Request(
             connection=self.connection, start_line=start_line,
             headers=headers)
 
-        if self.stream_request_body:
-            self.request.body = Future()
-            return self.execute()
+        status_code = self.application._check_request(self.request)
+        if status_code is not None:
+            if _announces_body(headers):
+                self.reject(status_code)
+            else:
+                # answering before the (empty) body is read would
+                # close the connection, reject in finish instead
+                self.reject_status = status_code
+            return
+
+        entry = getattr(self.request, 'resolved_route', (None, None))[0]
+        if entry is not None:
+            route = entry[0]
+            max_body_size = self.application._max_body_size(route)
+            if max_body_size is not None:
+                # make the http server enforce (or lift) the limit, this
+                # covers chunked bodies not announcing their length
+                self.connection.set_max_body_size(max_body_size)
+            stream = route.options.get('stream')
+            if stream:
+                # the route gets called right away and reads the body
+                # from the body_stream while it is received
+                self.stream_request_body = True
+                maxsize = 16 if stream is True else stream
+                self.body_stream = self.request.body_stream = rw.body.BodyStream(maxsize)
+                self.execute()
+                return
+        settings = self.application.rw_settings.get('rw.http', {})
+        self.body_reader = rw.body.create_reader(self.request, settings)
 
     def data_received(self, data):
         if self.stream_request_body:
-            return self.handler.data_received(data)
-        else:
-            self.chunks.append(data)
+            return self.body_stream.feed(data)
+        elif self.body_reader is not None:
+            self.body_reader.feed(data)
 
     def finish(self):
-        if self.stream_request_body:
-            self.request.body.set_result(None)
+        if self.reject_status is not None:
+            self.reject(self.reject_status)
+        elif self.stream_request_body:
+            self.body_stream.close()
         else:
-            self.request.body = b''.join(self.chunks)
-            self.request._parse_body()
+            self.body_reader.finish(self.request)
+            self.body_reader = None
             self.execute()
 
     def on_connection_close(self):
         if self.stream_request_body:
-            self.handler.on_connection_close()
+            self.body_stream.abort()
         else:
-            self.chunks = None
+            self.body_reader = None
+
+    def reject(self, status_code):
+        """Answer with an error page without reading the request body
+
+        Finishing the response before the body is read makes tornado
+        close the connection instead of receiving the body, so requests
+        without body are rejected once their (empty) body is read.
+        """
+        app = self.application
+        with app.scope():
+            request_scope = rw.scope.RequestScope()
+            with request_scope():
+                app._enter_host(request_scope, self.request)
+                handler = app.handler(app, self.request)
+                request_scope['handler'] = handler
+                handler._transforms = []  # usually set by _execute
+                handler.send_error(status_code)
 
     def execute(self):
         app = self.application
         with app.scope():
-            request_scope = rw.scope.Scope()
+            request_scope = rw.scope.RequestScope()
             with request_scope():
                 request_handling = app._handle_request(request_scope, self.request)
                 app.io_loop.add_future(request_handling, app._request_finished)
 
 
 class RequestHandler(tornado.web.RequestHandler, dict):
+    # chunks smaller than this are joined before they are written to
+    # the connection, larger ones are written as they are
+    write_coalesce_size = 16 * 1024
+
     def __init__(self, application, request, **kwargs):
         # The super class is not called since it creates
         # some structures we do not care about.  Since
@@ -195,6 +463,11 @@ class RequestHandler(tornado.web.RequestHandler, dict):
         self._auto_finish = False  # vanilla tornado defaults to True
         self._transforms = None  # will be set in _execute
         self._prepared_future = None
+        self._output_callbacks = None  # see capture_output
+        self._replayed = False  # see replay_output
+        self.etag_strategy = None  # see compute_etag
+        self._etag_version = None  # see check_version
+        self._flushing = None  # parts still being written, see flush
 
         # variables from vanilla tornado, not avaiable in rw
         # self.path_args
@@ -204,6 +477,12 @@ class RequestHandler(tornado.web.RequestHandler, dict):
         self.request.connection.set_close_callback(self.on_connection_close)
         self.initialize(**kwargs)
 
+    def set_default_headers(self):
+        allowed_methods = getattr(self.request, 'allowed_methods', None)
+        if allowed_methods:
+            # the request is answered with 405 Method Not Allowed
+            self.set_header('Allow', ', '.join(allowed_methods))
+
     def render(self, template_name, **kwargs):
         """Render..."""
         raise NotImplementedError()
@@ -237,6 +516,153 @@ class RequestHandler(tornado.web.RequestHandler, dict):
         """
         raise NotImplementedError()
 
+    def write(self, chunk):
+        """Writes the given chunk to the output buffer
+
+        In addition to what `tornado.web.RequestHandler.write` accepts
+        `memoryview` and `bytearray` chunks are buffered without copying
+        them on Python 3.  They must not be modified until the response
+        is flushed.  Python 2 copies them to `bytes`, it can neither join
+        nor checksum nor send them.
+        """
+        if isinstance(chunk, (memoryview, bytearray)):
+            if self._finished:
+                raise RuntimeError("Cannot write() after finish()")
+            if PY3:
+                chunk = memoryview(chunk)
+                if chunk.itemsize != 1:
+                    chunk = chunk.cast('B')
+            else:
+                chunk = as_bytes(chunk)
+            self._write_buffer.append(chunk)
+        else:
+            super(RequestHandler, self).write(chunk)
+
+    def _coalesced_write_buffer(self):
+        """Parts of the write buffer with adjacent small chunks joined"""
+        parts = []
+        small = []
+        for chunk in self._write_buffer:
+            if len(chunk) < self.write_coalesce_size:
+                small.append(as_bytes(chunk))
+                continue
+            if small:
+                parts.append(b''.join(small))
+                small = []
+            parts.append(chunk)
+        if small:
+            parts.append(b''.join(small))
+        return parts
+
+    def flush(self, include_footers=False, callback=None):
+        """Flushes the current output buffer to the network
+
+        Unlike `tornado.web.RequestHandler.flush` the buffer is not joined
+        into one string, large chunks are passed on to the connection one
+        after another: the connection copies everything written into its
+        own buffer, this way only one part is copied at a time.  The
+        returned future resolves once all parts are written.
+        """
+        if self._transforms:
+            # transforms work on a single chunk
+            return super(RequestHandler, self).flush(include_footers, callback)
+        parts = self._coalesced_write_buffer()
+        self._write_buffer = []
+        connection = self.request.connection
+        if self.request.method == "HEAD":
+            # Ignore the chunks and only write the headers for HEAD requests
+            parts = []
+
+        if not self._headers_written:
+            self._headers_written = True
+            # Finalize the cookie headers (which have been stored in a side
+            # object so an outgoing cookie could be overwritten before it
+            # is sent).
+            if hasattr(self, "_new_cookie"):
+                for cookie in self._new_cookie.values():
+                    self.add_header("Set-Cookie", cookie.OutputString(None))
+
+            start_line = tornado.httputil.ResponseStartLine('', self._status_code, self._reason)
+            first = None
+            if parts and len(parts[0]) < self.write_coalesce_size:
+                # send small bodies together with the headers
+                first = parts.pop(0)
+            if not parts:
+                return connection.write_headers(start_line, self._headers, first,
+                                                callback=callback)
+            connection.write_headers(start_line, self._headers, first)
+
+        if self._flushing is None and len(parts) <= 1:
+            return connection.write(parts[0] if parts else b'', callback=callback)
+
+        flushing = self._flushing = self._write_parts(self._flushing, parts)
+
+        def flushed(future):
+            if self._flushing is future:
+                self._flushing = None
+            if callback is not None and future.exception() is None:
+                callback()
+        flushing.add_done_callback(flushed)
+        return flushing
+
+    def _finish_request(self, flushing):
+        if flushing.exception() is None:
+            self.request.finish()
+
+    @gen.coroutine
+    def _write_parts(self, previous, parts):
+        """Write `parts` one by one after the `previous` flush completed"""
+        if previous is not None:
+            yield previous
+        connection = self.request.connection
+        for part in parts:
+            yield connection.write(part)
+
+    def compute_etag(self):
+        """Compute the ETag according to the configured strategy
+
+        The strategy is taken from `etag_strategy` (set from the
+        ``etag`` route option) or the ``etag`` setting of ``rw.http``
+        and defaults to ``sha1``, see `rw.cache.ETAG_STRATEGIES`.
+        """
+        settings = self.application.rw_settings.get('rw.http', {})
+        strategy = self.etag_strategy
+        if strategy is None:
+            strategy = settings.get('etag') or 'sha1'
+        if callable(strategy):
+            return strategy(self)
+        if strategy == 'version':
+            version = self._etag_version
+            if version is None:
+                version = settings.get('etag_version')
+            return None if version is None else rw.cache.etag_version(version)
+        compute = rw.cache.ETAG_STRATEGIES[strategy]
+        return None if compute is None else compute(self._write_buffer)
+
+    def check_version(self, version):
+        """Set a weak ETag for `version` and finish with 304 if it is current
+
+        Lets handlers skip rendering when the version of the content is
+        known up front::
+
+            @mod.get('/article/<id>')
+            def article(handler, id):
+                article = load_article(id)
+                if handler.check_version(article.modified):
+                    return
+                ...
+
+        :return bool: True if the client has `version` already and the
+                      response was finished with 304 Not Modified
+        """
+        self._etag_version = version
+        self.set_header('Etag', rw.cache.etag_version(version))
+        if self.request.method in ('GET', 'HEAD') and self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return True
+        return False
+
     def finish(self, chunk=None):
         """Finishes this response, ending the HTTP request."""
         if self._finished:
@@ -250,19 +676,26 @@ class RequestHandler(tornado.web.RequestHandler, dict):
         # Automatically support ETags and add the Content-Length header if
         # we have not flushed any content yet.
         if not self._headers_written:
+            check_etag = self._replayed
             if (self._status_code == 200 and
                 self.request.method in ("GET", "HEAD") and
                "Etag" not in self._headers):
                 self.set_etag_header()
-                if self.check_etag_header():
-                    self._write_buffer = []
-                    self.set_status(304)
+                check_etag = True
+            if self._output_callbacks:
+                self._run_output_callbacks(b''.join(self._write_buffer))
+            if check_etag and self.check_etag_header():
+                self._write_buffer = []
+                self.set_status(304)
             if self._status_code == 304:
                 assert not self._write_buffer, "Cannot send body with 304"
                 self._clear_headers_for_304()
             elif "Content-Length" not in self._headers:
                 content_length = sum(len(part) for part in self._write_buffer)
                 self.set_header("Content-Length", content_length)
+        elif self._output_callbacks:
+            # the response is already partially sent and cannot be replayed
+            self._run_output_callbacks(None)
 
         if hasattr(self.request, "connection"):
             # Now that the request is finished, clear the callback we
@@ -271,12 +704,53 @@ class RequestHandler(tornado.web.RequestHandler, dict):
             # are keepalive connections)
             self.request.connection.set_close_callback(None)
 
+        body_stream = getattr(self.request, 'body_stream', None)
+        if body_stream is not None:
+            # the connection would keep waiting for the unread body
+            body_stream.abort()
+
         self.flush(include_footers=True)
-        self.request.finish()
+        if self._flushing is None:
+            self.request.finish()
+        else:
+            # end the response once the remaining parts are written
+            self._flushing.add_done_callback(self._finish_request)
         self._log()
         self._finished = True
         self.on_finish()
 
+    def capture_output(self, callback):
+        """Call ``callback(status_code, headers, body)`` when the response
+        is finished, before it is sent.
+
+        `body` is None if the response cannot be replayed by `replay_output`
+        because parts of it were already flushed or it sets cookies.
+        """
+        if self._output_callbacks is None:
+            self._output_callbacks = []
+        self._output_callbacks.append(callback)
+
+    def _run_output_callbacks(self, body):
+        if getattr(self, '_new_cookie', None):
+            body = None
+        headers = self._headers.copy()
+        for callback in self._output_callbacks:
+            callback(self._status_code, headers, body)
+        self._output_callbacks = None
+
+    def on_connection_close(self):
+        super(RequestHandler, self).on_connection_close()
+        if self._output_callbacks:
+            self._run_output_callbacks(None)
+
+    def replay_output(self, status_code, headers, body):
+        """Finish with a response captured by `capture_output`"""
+        self.set_status(status_code)
+        self._headers = headers.copy()
+        self.set_header('Date', tornado.httputil.format_timestamp(time.time()))
+        self._replayed = True
+        self.finish(body)
+
     # methods to investigate for overwriting
     # def locale(self):
     # def get_user_locale(self):
@@ -343,31 +817,105 @@ class RequestHandler(tornado.web.RequestHandler, dict):
                 self._prepared_future.set_result(None)
 
     def handle_request(self):
-        routing_table = rw.scope.get('rw.http')['routing_table']
-        prefix, module, fn, args = routing_table.find_route(self.request.method, self.request.path)
+        resolved = getattr(self.request, 'resolved_route', None)
+        if resolved is None:
+            routing_table = rw.scope.get('rw.http')['routing_table']
+            if self.request.method.lower() not in routing_table:
+                raise tornado.web.HTTPError(405)
+            resolved = routing_table.resolve(self.request.method, self.request.path)
+        entry, args = resolved
         current_scope = rw.scope.get_current_scope()
-        current_scope['rw.routing.prefix'] = prefix
         current_scope['url_variables'] = args
-        current_scope['module'] = module
 
-        if fn is None:
+        if entry is None:
+            current_scope['rw.routing.prefix'] = None
+            current_scope['module'] = None
             raise tornado.web.HTTPError(404)
 
-        # only supply arguments if those are "welcome"
-        if hasattr(fn, '_rw_wrapped_function'):
-            arg_spec = inspect.getargspec(fn._rw_wrapped_function)
-        else:
-            arg_spec = inspect.getargspec(fn)
-
-        if arg_spec.keywords is not None:
-            # fn accepts **keywords arguments so we pass all variables
-            return fn(**args)
+        route, prefix, module, fn = entry
+        current_scope['rw.routing.prefix'] = prefix
+        current_scope['module'] = module
+        if route.options.get('stream'):
+            current_scope['body_stream'] = self.request.body_stream
+        if route.etag is not None:
+            self.etag_strategy = route.etag
+
+        if route.middleware_chain is not None:
+            return route.middleware_chain(functools.partial(self._dispatch, route, args))
+        return self._dispatch(route, args)
+
+    def _dispatch(self, route, args):
+        if self.request.method == 'GET':
+            if route.cache_policy is not None:
+                if self._serve_from_cache(route.cache_policy):
+                    return
+            if route.coalesce_policy is not None:
+                leader = self._coalesce(route.coalesce_policy)
+                if leader is not None:
+                    return self._wait_for_leader(leader, route, args)
+
+        return self._call_route(route, args)
+
+    def _call_route(self, route, args):
+        if route.options.get('process'):
+            return rw.scope.get('process_pool').submit_route(route.call_plan, args)
+        if route.options.get('executor'):
+            try:
+                return rw.scope.get('executor').submit(route.call_plan, args)
+            except rw.executor.QueueFull:
+                raise HTTPError(503)
+        # only supply arguments if those are "welcome",
+        # see rw.routing.CallPlan
+        return route.call_plan(args)
+
+    def _serve_from_cache(self, policy):
+        """Finish from `rw.cache.ResponseCache` or capture the response for it
+
+        :return bool: True if the response was served from cache
+        """
+        cache = rw.scope.get('rw.http')['response_cache']
+        key = policy.key(self.request)
+        entry = cache.get(key)
+        if entry is not None:
+            # skip injection, the handler and rendering altogether
+            self.replay_output(entry.status_code, entry.headers, entry.body)
+            return True
+
+        def store(status_code, headers, body):
+            if status_code == 200 and body is not None:
+                cache.put(key, status_code, headers, body, policy.ttl)
+        self.capture_output(store)
+        return False
+
+    def _coalesce(self, policy):
+        """Join an identical request in flight or become its leader
+
+        :return: Future of the leader's response or None if this
+                 request is the leader
+        """
+        coalescer = rw.scope.get('rw.http')['coalescer']
+        key = policy.key(self.request)
+        leader = coalescer.join(key)
+        if leader is None:
+            def resolve(status_code, headers, body):
+                if status_code != 200:
+                    # e.g. 304 for a conditional request, followers
+                    # without the same condition run on their own
+                    body = None
+                coalescer.resolve(key, status_code, headers, body)
+            self.capture_output(resolve)
+        return leader
 
-        call_args = {}
-        for arg, value in args.items():
-            if arg in arg_spec.args:
-                call_args[arg] = value
-        return fn(**call_args)
+    @gen.coroutine
+    def _wait_for_leader(self, leader, route, args):
+        status_code, headers, body = yield leader
+        if body is None:
+            # the leader's response cannot be replayed, run on our own
+            result = self._call_route(route, args)
+            if is_future(result):
+                result = yield result
+            raise gen.Return(result)
+        self.replay_output(status_code, headers, body)
 
     # overwrite methodes that are not supported to make sure
     # they get not used by accident.
@@ -15,12 +15,17 @@ from __future__ import absolute_import, division, print_function, with_statement
 import inspect
 
 import re
+import functools
+import sys
+import time
+import collections
 
-from future.builtins import range
-from tornado import util
+from tornado import gen, util
 import tornado.web
 
 from rw import scope
+import rw.cache
+import rw.executor
 import rw.plugin
 
 
@@ -87,49 +92,64 @@ class NoMatchError(Exception):
 
 
 class Route(object):
-    def __init__(self, path):
-        """Rule for `callback` matching given `path`"""
+    def __init__(self, path, fn=None, options=None):
+        """Rule for `callback` matching given `path`
+
+        :param str path: url rule
+        :param fn: route function, see `CallPlan`
+        :param dict options: route options as given to `rw.http.Module.get` etc.
+        """
         self.path = path.rstrip('/')
         self.route = list(parse_rule(path))
-
-    def _sort_struct(self):
-        variables = [route[0] for route in self.route if route[0] is not None]
-        strings = [route[2] for route in self.route if route[0] is None]
-        return variables, strings
+        self.dynamic = any(converter for converter, args, data in self.route)
+        self.variables = tuple(data for converter, args, data in self.route if converter)
+        self.parts = None  # see bind_converters
+        self.options = options if options is not None else {}
+        self.call_plan = CallPlan(fn, self.variables) if fn is not None else None
+        self.cache_policy = rw.cache.CachePolicy.create(self.options.get('cache'))
+        self.coalesce_policy = rw.cache.CachePolicy.create(self.options.get('coalesce'))
+        # full middleware chain, including the middleware of all
+        # modules the route is mounted in, see RoutingTable.setup
+        self.middleware = tuple(self.options.get('middleware', ()))
+        self.middleware_chain = None  # see RoutingTable.setup
+        # maximum Content-Length, see rw.httpbase.RequestDispatcher
+        self.max_body_size = self.options.get('max_body_size')
+        self.etag = rw.cache.check_etag_strategy(self.options.get('etag'))
+        self.sort_key = self._sort_key()
+        # template for get_path, braces in static parts are escaped
+        self.path_template = ''.join(
+            '{}' if converter else data.replace('{', '{{').replace('}', '}}')
+            for converter, args, data in self.route)
+        if not self.dynamic:
+            self.static_path = ''.join(data for converter, args, data in self.route)
+
+    def _sort_key(self):
+        """Precedence of this route as tuple, smaller sorts first:
+
+         1. fewer variables
+         2. longer static parts
+         3. static parts in alphabetical order
+         4. variables with non-default converters
+        """
+        variables = tuple(route[0] for route in self.route if route[0] is not None)
+        strings = tuple(route[2] for route in self.route if route[0] is None)
+        return (len(variables),
+                -len(''.join(strings)),
+                strings,
+                tuple(variable == 'str' for variable in variables))
 
     def __lt__(self, o):
         """less than `o`
 
         :param Route o: other rule to compare with
         """
-        if self == o:
-            return False
-
-        variables, strings = self._sort_struct()
-        variables_o, strings_o = o._sort_struct()
-        if len(variables) != len(variables_o):
-            return len(variables) < len(variables_o)
-
-        if len(''.join(strings)) != len(''.join(strings_o)):
-            return len(''.join(strings)) > len(''.join(strings_o))
-
-        for i in range(len(strings)):
-            if strings[i] != strings_o[i]:
-                return strings[i] < strings_o[i]
-
-        # strings are the same, so check variables for non-default parser
-        for i in range(len(variables)):
-            if variables[i] != 'str' and variables_o[i] == 'str':
-                return True
-        return False
+        return self.sort_key < o.sort_key
 
     def __gt__(self, o):
         """greater than `o`
 
         :param Route o: other rule to compare with
         """
-        if self == o:
-            return False
         return o < self
 
     def __eq__(self, o):
@@ -139,15 +159,32 @@ class Route(object):
         """
         return self.route == o.route
 
-    @rw.scope.inject
-    def match(self, test_path, scope):
-        arguments = {}
+    def bind_converters(self, converters=None):
+        """Resolve the converter names of this route to callables
+
+        :param dict converters: converter name -> converter function,
+                                defaults to ``rw.routing:converters`` from
+                                the current scope
+        :raise AttributeError: if a converter is not available
+        """
+        if self.dynamic and converters is None:
+            converters = rw.scope.get('rw.routing:converters')
+        parts = []
         for converter_name, args, data in self.route:
+            converter = None
             if converter_name:
-                converters = rw.scope.get('rw.routing:converters')
                 converter = converters.get(converter_name)
                 if converter is None:
                     raise AttributeError('No converter for {} available'.format(converter_name))
+            parts.append((converter, data))
+        self.parts = parts
+
+    def match(self, test_path):
+        if self.parts is None:
+            self.bind_converters()
+        arguments = {}
+        for converter, data in self.parts:
+            if converter:
                 try:
                     consumed, arguments[data] = converter(test_path)
                 except NoMatchError:
@@ -162,20 +199,146 @@ class Route(object):
         return None
 
     def get_path(self, values=None):
-        if values is None:
-            values = {}
-        re = []
-        for converter, args, data in self.route:
-            if converter:
-                re.append(util.unicode_type(values[data]))
-            else:
-                re.append(data)
-        return ''.join(re)
+        if not self.dynamic:
+            return self.static_path
+        return self.path_template.format(*[util.unicode_type(values[variable])
+                                           for variable in self.variables])
 
     def __repr__(self):
         return '<Rule "%s">' % self.path
 
 
+_MISSING = object()
+
+
+class CallPlan(object):
+    """Precompiled invocation of a route function
+
+    The function signature is inspected once when the route is added
+    instead of on every request: which url variables get passed, whether
+    ``**kwargs`` are accepted and which arguments are taken from scope.
+    """
+    def __init__(self, fn, variables):
+        """
+        :param fn: route function, optionally wrapped by `rw.scope.inject`
+        :param tuple variables: names of the url variables of the route
+        """
+        # call the function wrapped by rw.scope.inject directly,
+        # injection is done by the plan itself
+        target = fn
+        inject = False
+        while hasattr(target, '_rw_injected_function'):
+            target = target._rw_injected_function
+            inject = True
+        fn_inspect = getattr(target, '_rw_wrapped_function', target)
+        arg_spec = inspect.getargspec(fn_inspect)
+
+        self.fn = target
+        self.args = tuple(arg_spec.args)
+        self.keywords = arg_spec.keywords is not None
+        if self.keywords:
+            # fn accepts **keywords arguments so we pass all variables
+            self.url_args = variables
+        else:
+            self.url_args = tuple(arg for arg in variables if arg in arg_spec.args)
+        if inject:
+            self.scope_args = tuple(arg for arg in arg_spec.args if arg not in variables)
+        else:
+            self.scope_args = ()
+
+    def __call__(self, url_variables):
+        kwargs = {}
+        pending = None
+        for arg in self.url_args:
+            kwargs[arg] = url_variables[arg]
+        for arg in self.scope_args:
+            value = rw.scope.get(arg, _MISSING)
+            # the key might not be inside scope but there might be
+            # a default parameter defined inside the function
+            if value is not _MISSING:
+                kwargs[arg] = value
+                if rw.scope.is_provided_future(value):
+                    if pending is None:
+                        pending = []
+                    pending.append(arg)
+        if pending is None:
+            return self.fn(**kwargs)
+        return self._call_provided(kwargs, pending)
+
+    @gen.coroutine
+    def _call_provided(self, kwargs, pending):
+        """Wait for values of coroutine providers, then call the function"""
+        values = yield [kwargs[arg] for arg in pending]
+        kwargs.update(zip(pending, values))
+        result = self.fn(**kwargs)
+        if gen.is_future(result):
+            result = yield result
+        raise gen.Return(result)
+
+
+class MiddlewarePlan(CallPlan):
+    """`CallPlan` of a middleware
+
+    The first argument is the next element of the middleware chain,
+    the others are injected like those of route functions, including
+    the results of coroutine providers.
+    """
+    def __init__(self, fn, next_plan=None):
+        """
+        :param fn: middleware function
+        :param MiddlewarePlan next_plan: next middleware of the chain,
+                                         None for the last one
+        """
+        super(MiddlewarePlan, self).__init__(fn, ())
+        if not self.args:
+            raise TypeError('middleware {} must take the next element of the chain '
+                            'as first argument'.format(fn.__name__))
+        self.next_arg = self.args[0]
+        self.url_args = (self.next_arg,)
+        self.scope_args = tuple(arg for arg in self.scope_args if arg != self.next_arg)
+        self.next_plan = next_plan
+
+    def __call__(self, call):
+        if self.next_plan is None:
+            call_next = call
+        else:
+            call_next = functools.partial(self.next_plan, call)
+        return super(MiddlewarePlan, self).__call__({self.next_arg: call_next})
+
+
+def compile_middleware(middleware):
+    """Compose the `middleware` chain into one callable
+
+    :return: ``chain(call)`` running `call` wrapped by all `middleware`
+             or None if there is no middleware
+    """
+    chain = None
+    for mw in reversed(middleware):
+        chain = MiddlewarePlan(mw, chain)
+    return chain
+
+
+def run_middleware(middleware, call):
+    """Run `call` wrapped by the `middleware` chain
+
+    Every middleware is called with the next element of the chain
+    as first argument and returns its result (or a Future)::
+
+        @rw.scope.inject
+        def require_user(call_next, user):
+            if user is None:
+                raise tornado.web.HTTPError(403)
+            return call_next()
+
+    Routes compose their chain once during `RoutingTable.setup`,
+    see `compile_middleware`.
+    """
+    chain = compile_middleware(middleware)
+    if chain is None:
+        return call()
+    return chain(call)
+
+
 def _generate_request_handler_proxy(handler_class, handler_args, name):
     """When a tornado.web.RequestHandler gets mounted we create a launcher function"""
 
@@ -190,6 +353,164 @@ def _generate_request_handler_proxy(handler_class, handler_args, name):
     return request_handler_wrapper
 
 
+class _TrieNode(object):
+    """Node of the radix trie used by `RoutingTable.find_route`
+
+    Static url parts are stored as (compressed) edges keyed by their
+    first character, converters as typed wildcard children.
+    """
+    def __init__(self):
+        self.edges = {}  # first character -> (label, child)
+        self.wildcards = []  # [(converter name, converter args, child, converter)]
+        self.routes = []  # [(priority, variable names, entry)]
+        self.min_priority = None
+
+    def insert_static(self, data, path):
+        """Insert static `data` below this node and return the final node
+
+        Every node traversed or created on the way is appended to `path`.
+        """
+        node = self
+        while data:
+            edge = node.edges.get(data[0])
+            if edge is None:
+                child = _TrieNode()
+                node.edges[data[0]] = (data, child)
+                path.append(child)
+                return child
+            label, child = edge
+            common = 1
+            max_common = min(len(label), len(data))
+            while common < max_common and label[common] == data[common]:
+                common += 1
+            if common < len(label):
+                # split the edge at the first differing character
+                middle = _TrieNode()
+                middle.min_priority = child.min_priority
+                middle.edges[label[common]] = (label[common:], child)
+                node.edges[data[0]] = (label[:common], middle)
+                child = middle
+            node = child
+            path.append(node)
+            data = data[common:]
+        return node
+
+    def insert_wildcard(self, converter_name, args, converter):
+        for name, wildcard_args, child, _ in self.wildcards:
+            if name == converter_name and wildcard_args == args:
+                return child
+        child = _TrieNode()
+        self.wildcards.append((converter_name, args, child, converter))
+        return child
+
+
+class RouteTrie(object):
+    """Prefix trie over all routes of one HTTP method
+
+    Lookup cost depends on the length of the requested path instead of
+    the number of routes.  If multiple routes match, the one sorted first
+    (see `Route.__lt__`) wins, same as a linear scan over the sorted routes.
+    """
+    def __init__(self, entries):
+        """
+        :param list entries: sorted routing table entries
+                             in the form ``(route, name_prefix, module, fn)``,
+                             with converters bound (see `Route.bind_converters`)
+        """
+        self.root = _TrieNode()
+        for priority, entry in enumerate(entries):
+            self.insert(priority, entry)
+
+    def insert(self, priority, entry):
+        route = entry[0]
+        node = self.root
+        path = [node]
+        variables = []
+        for (converter_name, args, data), (converter, _) in zip(route.route, route.parts):
+            if converter_name:
+                node = node.insert_wildcard(converter_name, args, converter)
+                variables.append(data)
+                path.append(node)
+            else:
+                node = node.insert_static(data, path)
+        node.routes.append((priority, tuple(variables), entry))
+        for node in path:
+            if node.min_priority is None or priority < node.min_priority:
+                node.min_priority = priority
+
+    def match(self, path):
+        """Return ``(entry, arguments)`` of the best matching route
+        or ``(None, None)``"""
+        best = self._match(self.root, path, [])
+        if best is None:
+            return None, None
+        priority, variables, entry, values = best
+        return entry, dict(zip(variables, values))
+
+    def _match(self, node, path, values, best=None):
+        if best is not None and node.min_priority >= best[0]:
+            # nothing below this node can beat the current match
+            return best
+
+        if not path and node.routes:
+            priority, variables, entry = node.routes[0]
+            if best is None or priority < best[0]:
+                best = (priority, variables, entry, list(values))
+
+        if path:
+            edge = node.edges.get(path[0])
+            if edge is not None and path.startswith(edge[0]):
+                best = self._match(edge[1], path[len(edge[0]):], values, best)
+
+        for _, _, child, converter in node.wildcards:
+            if best is not None and child.min_priority >= best[0]:
+                continue
+            try:
+                consumed, value = converter(path)
+            except NoMatchError:
+                continue
+            values.append(value)
+            best = self._match(child, path[consumed:], values, best)
+            values.pop()
+        return best
+
+
+class DispatchCache(object):
+    """Bounded LRU cache for `RoutingTable.resolve`
+
+    Maps ``(method, path)`` to the resolved routing table entry and url
+    arguments.  Misses (unknown paths) are cached as well.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key):
+        """Return the cached ``(entry, args)`` for `key` or None"""
+        try:
+            # re-insert to mark as most recently used
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
 class RoutingTable(dict):
     def __init__(self, name):
         dict.__init__(self)
@@ -197,15 +518,49 @@ class RoutingTable(dict):
         self.prefix = ''
         self.sub_rt = []  # child routing tables
         self.fn_namespace = {}
+        self.tries = None
+        self.cache = None  # see enable_cache
+        self.stats = {}  # see setup
+        self.named_routes = {}  # see get_route
+        self.middleware = ()  # middleware of all routes of the module
         for method in ['get', 'post', 'put', 'delete', 'options']:
             self[method] = []
 
-    def setup(self):
-        """setup routing table"""
+    def setup(self, converters=None, flatten=False):
+        """setup routing table
+
+        :param dict converters: converters to bind to the routes, defaults to
+                                ``rw.routing:converters`` of the current scope
+                                if any route needs one.
+        :param bool flatten: build one routing table for the whole mount tree
+                             instead of setting up every child table and
+                             copying its routes level by level.
+        """
+        start = time.time()
+        for entries in self.values():
+            for route, name_prefix, _, _ in entries:
+                if name_prefix == '':
+                    # route of this module
+                    route.middleware = self.middleware + tuple(route.options.get('middleware', ()))
+        if flatten:
+            self._setup_flat()
+        else:
+            self._setup_nested(converters)
+
+        # sort all rules
+        for key in self:
+            self[key].sort(key=lambda rule: rule[0].sort_key)
+            for route, _, _, _ in self[key]:
+                # middleware with a broken signature fails here
+                route.middleware_chain = compile_middleware(route.middleware)
+        self.build_tries(converters)
+        self.stats = self._stats(time.time() - start)
+
+    def _setup_nested(self, converters):
         # get all routes from submodules
         for prefix, routes in self.sub_rt:
             routes.prefix = self.prefix + prefix
-            routes.setup()
+            routes.setup(converters)
 
             fn_name_prefixes = {}
             for fn_key, fn in routes.fn_namespace.items():
@@ -219,33 +574,129 @@ class RoutingTable(dict):
                 funcs = set(rule[1] for rule in self[key])
                 for route, route_module, module, fn in routes.get(key, []):
                     if fn not in funcs:
-                        new_route = Route(prefix + route.path)
+                        new_route = Route(prefix + route.path, fn, route.options)
+                        new_route.middleware = self.middleware + route.middleware
                         fn.rw_route = new_route
                         fn_name_prefix = fn_name_prefixes[fn]
                         data = (new_route, fn_name_prefix, module, fn)
                         self[key].append(data)
 
-        # sort all rules
-        for key in self:
-            self[key].sort(key=lambda rule: rule[0])
-
-    def add_route(self, method, path, module, fn):
-        route = Route(path)
+    def _setup_flat(self):
+        for prefix, routes in self.sub_rt:
+            sub_tables = routes._walk(prefix, routes.name, self.middleware)
+            for table, path_prefix, name_prefix, middleware in sub_tables:
+                table.prefix = self.prefix + path_prefix
+                for fn_key, fn in table.fn_namespace.items():
+                    self.fn_namespace[name_prefix + '.' + fn_key] = fn
+
+                for key, entries in table.items():
+                    for route, _, module, fn in entries:
+                        new_route = Route(path_prefix + route.path, fn, route.options)
+                        route_middleware = tuple(route.options.get('middleware', ()))
+                        new_route.middleware = middleware + route_middleware
+                        fn.rw_route = new_route
+                        self.setdefault(key, []).append((new_route, name_prefix, module, fn))
+                    # the routes now live in the top level table only
+                    del entries[:]
+                table.tries = None
+
+    def _walk(self, path_prefix, name_prefix, middleware=()):
+        """yield this and all mounted routing tables
+
+        together with their path and name prefix and the
+        middleware applying to all of their routes"""
+        middleware += self.middleware
+        yield self, path_prefix, name_prefix, middleware
+        for prefix, routes in self.sub_rt:
+            sub_tables = routes._walk(path_prefix + prefix, name_prefix + '.' + routes.name,
+                                      middleware)
+            for table in sub_tables:
+                yield table
+
+    def _stats(self, setup_time):
+        """statistics about the routing tables of the mount tree"""
+        routes = {}
+        for table, _, _, _ in self._walk('', self.name):
+            for entries in table.values():
+                for entry in entries:
+                    routes[id(entry[0])] = entry[0]
+        memory = 0
+        for route in routes.values():
+            memory += sys.getsizeof(route) + sys.getsizeof(route.__dict__)
+            memory += sys.getsizeof(route.route) + sum(sys.getsizeof(part) for part in route.route)
+        return {
+            'setup_time': setup_time,
+            'routes': sum(len(entries) for entries in self.values()),
+            'route_objects': len(routes),
+            'memory': memory,
+        }
+
+    def build_tries(self, converters=None):
+        """compile the sorted routes into one `RouteTrie` per method
+
+        Converters are resolved here, once, so a missing converter
+        fails at startup instead of on the first matching request.
+        So do routes that cannot run in the process pool.
+        """
+        for entries in self.values():
+            for entry in entries:
+                route = entry[0]
+                if route.options.get('process'):
+                    rw.executor.check_process_route(route.call_plan)
+                if route.parts is None:
+                    if route.dynamic and converters is None:
+                        converters = rw.scope.get('rw.routing:converters')
+                    route.bind_converters(converters)
+        self.tries = dict((key, RouteTrie(entries)) for key, entries in self.items())
+        self.named_routes.clear()
+        if self.cache is not None:
+            self.cache.clear()
+
+    def enable_cache(self, size):
+        """Cache up to `size` results of `resolve`, see `DispatchCache`"""
+        self.cache = DispatchCache(size) if size > 0 else None
+
+    def add_route(self, method, path, module, fn, options=None):
+        route = Route(path, fn, options)
         self.setdefault(method, []).append((route, '', module, fn))
+        self.tries = None
+        if self.cache is not None:
+            self.cache.clear()
         # if fn.__name__ in self.fn_namespace:
         #     msg = 'Module already contains route with name {}'.format(fn.__name__)
         #     raise DuplicateError(msg)
         fn.rw_route = route
         self.fn_namespace[fn.__name__] = fn
+        self.named_routes.clear()
         return route
 
-    def get_path(self, func, kwargs):
-        if func not in self.fn_namespace:
+    def get_route(self, func, prefix=None):
+        """Route of the function named `func`
+
+        :param str func: function name, relative to `prefix` if given
+        :param str prefix: name prefix of the current module
+        :return Route: the route or None
+        """
+        key = (prefix, func)
+        try:
+            return self.named_routes[key]
+        except KeyError:
+            pass
+        name = func if prefix is None else (prefix + func).lstrip('.')
+        route = None
+        if name in self.fn_namespace:
+            route = self.fn_namespace[name].rw_route
+        self.named_routes[key] = route
+        return route
+
+    def get_path(self, func, kwargs, prefix=None):
+        route = self.get_route(func, prefix)
+        if route is None:
             # TODO do something more sensitve
             # - Log warning
             # - return actual 404 url
             return '404'
-        return self.fn_namespace[func].rw_route.get_path(kwargs)
+        return route.get_path(kwargs)
 
     def add_request_handler(self, path, module, handler_args, name):
         if name is None:
@@ -270,12 +721,45 @@ class RoutingTable(dict):
             # module.routes.prefix = path
         self.sub_rt.append((path, rt))
 
+    def resolve(self, method, path):
+        """Find the route for `method` and `path`
+
+        :return: the routing table entry ``(route, name_prefix, module, fn)``
+                 and the url arguments or ``(None, None)``
+        """
+        if self.tries is None:
+            self.build_tries()
+        method = method.lower()
+        if self.cache is None:
+            return self.tries[method].match(path)
+
+        key = (method, path)
+        cached = self.cache.get(key)
+        if cached is None:
+            cached = self.tries[method].match(path)
+            self.cache.put(key, cached)
+        entry, args = cached
+        if args is not None:
+            # the arguments end up in the request scope, do not share them
+            args = dict(args)
+        return entry, args
+
+    def allowed_methods(self, path):
+        """HTTP methods with a route for `path`, e.g. for the Allow header
+
+        Only needed for misses, so the tries are queried directly instead
+        of filling the dispatch cache with an entry for every method.
+        """
+        if self.tries is None:
+            self.build_tries()
+        return [method.upper() for method in sorted(self)
+                if self.tries[method].match(path)[0] is not None]
+
     def find_route(self, method, path):
-        for x in self[method.lower()]:
-            rule, name_prefix, module, fn = x
-            args = rule.match(path)
-            if args is not None:
-                return name_prefix, module, fn, args
+        entry, args = self.resolve(method, path)
+        if entry is not None:
+            rule, name_prefix, module, fn = entry
+            return name_prefix, module, fn, args
         return None, None, None, None
 
 
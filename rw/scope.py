@@ -11,37 +11,204 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+"""Scopes and dependency injection
+
+The chain of active scopes is stored in a `contextvars.ContextVar`
+(per thread on Python < 3.7, which lacks `contextvars`).  Other threads
+enter a captured `ScopeChain` explicitly, see `chain_context`.
+
+On tornado 4 ``stack_context`` remains the mechanism that carries the
+chain through callbacks and coroutines: tornado < 6 does not propagate
+context variables itself, so entering a scope still wraps callbacks in
+a ``StackContext``.  Only without ``stack_context`` (tornado >= 6) is the
+chain carried by the context variable alone.
+"""
 from __future__ import absolute_import, division, print_function, with_statement
 
-import sys
-import contextlib
+import time
+import weakref
 import functools
 import inspect
+import threading
 
-from tornado import stack_context
+try:
+    import contextvars
+except ImportError:  # python < 3.7
+    contextvars = None
+
+try:
+    from tornado import stack_context
+except ImportError:  # tornado >= 6
+    stack_context = None
 
 import rw.cfg
 from . import gen
 
 
 NOT_PROVIDED = object()
-SCOPE_CHAIN = None
+NOT_FOUND = object()
+_IN_PARENT = object()  # cached by ScopeChain for keys of outer scopes
+# futures created by coroutine providers, see `is_provided_future`
+_PROVIDED_FUTURES = weakref.WeakSet()
 
 
 class OutsideScopeError(Exception):
     pass
 
 
+class LookupStats(object):
+    """Counters of lookups answered from / missing the `ScopeChain` cache"""
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+
+STATS = LookupStats()
+
+
+class ScopeChain(object):
+    """Immutable chain of active scopes
+
+    Caches the result of every lookup done via `get`.  A chain only
+    caches what it finds in its innermost scope, keys not found there
+    are looked up in the `parent` chain, which caches them on its own:
+    the values of the application scope stay cached while request
+    scopes come and go and are written to.  Validating the cache
+    therefore only compares the version of the innermost scope.
+
+    Entering a scope creates a new chain, unless the scope was entered
+    on top of the same chain before (e.g. when ``StackContext``
+    re-enters it for every callback).
+    """
+    __slots__ = ('scopes', 'innermost_first', 'parent', 'version', 'values')
+
+    def __init__(self, scopes=(), parent=None):
+        self.scopes = scopes  # outermost first
+        self.innermost_first = list(reversed(scopes))
+        self.parent = parent  # chain without the innermost scope
+        self.version = scopes[-1]._version if scopes else 0
+        self.values = {}
+
+    def push(self, scope):
+        pushed = scope._pushed
+        if pushed is not None and pushed[0] is self:
+            return pushed[1]
+        chain = ScopeChain(self.scopes + (scope,), self if self.scopes else None)
+        scope._pushed = self, chain
+        return chain
+
+    def lookup(self, key):
+        """Return value for `key` or `NOT_FOUND`"""
+        return self._lookup(key)[0]
+
+    def _lookup(self, key):
+        scope = self.scopes[-1]
+        version = scope._version
+        if self.version != version:
+            self.values = {}
+            self.version = version
+        value = self.values.get(key, NOT_FOUND)
+        if value is _IN_PARENT:
+            return self.parent._lookup(key)
+        if value is not NOT_FOUND:
+            STATS.hits += 1
+            return value, True
+
+        value, cacheable = _lookup_scope(key, scope, self.innermost_first)
+        if value is NOT_FOUND and self.parent is not None:
+            if scope._version == version:
+                self.values[key] = _IN_PARENT
+            return self.parent._lookup(key)
+        STATS.misses += 1
+        if cacheable and scope._version == version:
+            # only cache if resolving did not write to the scope
+            # (e.g. by running a provider)
+            self.values[key] = value
+        return value, cacheable
+
+
+class _ThreadLocalVar(threading.local):
+    """Fallback for `contextvars.ContextVar`, one value per thread"""
+    def __init__(self, name, default):
+        # called again with the same arguments in every thread
+        self.name = name
+        self.value = default
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+EMPTY_CHAIN = ScopeChain()
+if contextvars is not None:
+    _CURRENT_CHAIN = contextvars.ContextVar('rw.scope.chain', default=EMPTY_CHAIN)
+else:
+    _CURRENT_CHAIN = _ThreadLocalVar('rw.scope.chain', EMPTY_CHAIN)
+
+get_chain = _CURRENT_CHAIN.get
+
+
 class Scope(dict):
     def __init__(self, name=None):
         super(Scope, self).__init__()
+        self._version = 0  # increased on every write, see ScopeChain
+        self._pushed = None  # (parent chain, chain), see ScopeChain.push
         self._provider = {}
+        self._provider_ttl = {}
+        self._provided = {}
         self._subscopes = {}
         self.name = name
         self.plugins = set()
 
-    def provider(self, key, provider):
-        self._provider[key] = provider
+    # all modifications must invalidate cached lookups of ScopeChain
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._version += 1
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._version += 1
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._version += 1
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._version += 1
+
+    def pop(self, *args):
+        self._version += 1
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._version += 1
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self._version += 1
+
+    def provider(self, key, provider, ttl=None):
+        """Provide the value for `key` by calling `provider` on first use
+
+        `provider` is only called once a value for `key` is actually
+        looked up, its result is then stored in this scope.  If it
+        returns a future or coroutine the future is stored instead,
+        route functions and middleware of `rw.http.Module` get the
+        result injected (see `rw.routing.CallPlan`), `inject` passes
+        the future itself.  Failed futures are not kept, the
+        provider is called again on next use.
+
+        :param str key:
+        :param provider: callable without arguments
+        :param float ttl: seconds after which `provider` is called again,
+                          by default the value lives as long as the scope
+        """
+        _set_provider(self, key, provider, ttl)
 
     @gen.coroutine
     def activate(self, plugin):
@@ -53,6 +220,7 @@ class Scope(dict):
             name = '{}.{}'.format(self.name, key)
             subscope = SubScope(name, self)
             self._subscopes[key] = subscope
+            self._version += 1
         return self._subscopes[key]
 
     def get(self, key, default=NOT_PROVIDED, scopes=None):
@@ -64,33 +232,231 @@ class Scope(dict):
         :param str prefix:
         :return: :raise IndexError:
         """
-        if scopes is None:
-            scopes = list(reversed(SCOPE_CHAIN))
         if key == 'scope':
             return self
-
-        for i, scope in enumerate(scopes):
-            if key in scope:
-                return scope[key]
-            elif key in scope._provider:
-                scope[key] = scope._provider[key]()
-                del scope._provider[key]
-                return scope[key]
-            elif key in scope._subscopes:
-                return SubScopeView(key, scopes)
-
-        if default is not NOT_PROVIDED:
-            return default
-
-        msg = 'No value for "{}" stored and no default given'.format(key)
-        raise IndexError(msg)
+        return _get(key, default, scopes)
 
     def __call__(self):
-        return stack_context.StackContext(functools.partial(set_context, self))
+        if stack_context is None:
+            return _ChainContext(None, self)
+        return stack_context.StackContext(functools.partial(_ChainContext, None, self))
 
     @rw.gen.coroutine
     def run(self, target_coroutine):
-        yield stack_context.run_with_stack_context(self(), target_coroutine)
+        if stack_context is None:
+            with self():
+                # start inside the scope, the task copies the context
+                future = gen.convert_yielded(target_coroutine())
+            yield future
+        else:
+            yield stack_context.run_with_stack_context(self(), target_coroutine)
+
+
+_NOTHING = {}  # shared placeholder of RequestScope, never written to
+
+
+class RequestScope(object):
+    """Slim scope for the values of a single request
+
+    The well-known per request keys are stored in slots, other keys in
+    a dict that is only created when needed.  Behaves like `Scope` as
+    part of the scope chain but does not support plugins or subscopes.
+    """
+    __slots__ = ('handler', 'module', 'url_variables', 'routing_prefix', 'http',
+                 'template_env', '_version', '_pushed', '_extras', '_provider', '_provider_ttl',
+                 '_provided')
+    _slot_keys = {
+        'handler': 'handler',
+        'module': 'module',
+        'url_variables': 'url_variables',
+        'rw.routing.prefix': 'routing_prefix',
+        'rw.http': 'http',
+        'template_env': 'template_env',
+    }
+    _subscopes = _NOTHING
+    name = 'request'
+
+    def __init__(self):
+        self._version = 0
+        self._pushed = None
+        self.handler = NOT_FOUND
+        self.module = NOT_FOUND
+        self.url_variables = NOT_FOUND
+        self.routing_prefix = NOT_FOUND
+        self.http = NOT_FOUND
+        self.template_env = NOT_FOUND
+        self._extras = _NOTHING
+        self._provider = _NOTHING
+        self._provider_ttl = _NOTHING
+        self._provided = _NOTHING
+
+    def __contains__(self, key):
+        slot = self._slot_keys.get(key)
+        if slot is not None:
+            return getattr(self, slot) is not NOT_FOUND
+        return key in self._extras
+
+    def __getitem__(self, key):
+        slot = self._slot_keys.get(key)
+        if slot is None:
+            return self._extras[key]
+        value = getattr(self, slot)
+        if value is NOT_FOUND:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        slot = self._slot_keys.get(key)
+        if slot is not None:
+            setattr(self, slot, value)
+        else:
+            if self._extras is _NOTHING:
+                self._extras = {}
+            self._extras[key] = value
+        self._version += 1
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        slot = self._slot_keys.get(key)
+        if slot is not None:
+            setattr(self, slot, NOT_FOUND)
+        else:
+            del self._extras[key]
+        self._version += 1
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def provider(self, key, provider, ttl=None):
+        """See `Scope.provider`"""
+        if self._provider is _NOTHING:
+            self._provider = {}
+            self._provider_ttl = {}
+            self._provided = {}
+        _set_provider(self, key, provider, ttl)
+
+    def get(self, key, default=NOT_PROVIDED, scopes=None):
+        """See `Scope.get`"""
+        if key == 'scope':
+            return self
+        return _get(key, default, scopes)
+
+    def __call__(self):
+        if stack_context is None:
+            return _ChainContext(None, self)
+        return stack_context.StackContext(functools.partial(_ChainContext, None, self))
+
+
+def _set_provider(scope, key, provider, ttl):
+    scope._provider[key] = provider
+    scope._provided.pop(key, None)
+    if ttl is None:
+        scope._provider_ttl.pop(key, None)
+    else:
+        scope._provider_ttl[key] = ttl
+    scope._version += 1
+
+
+def _get(key, default, scopes):
+    if scopes is None:
+        scopes = get_chain().innermost_first
+
+    value = _resolve(key, scopes)
+    if value is not NOT_FOUND:
+        return value
+
+    if default is not NOT_PROVIDED:
+        return default
+
+    msg = 'No value for "{}" stored and no default given'.format(key)
+    raise IndexError(msg)
+
+
+def _resolve(key, scopes):
+    """Value for `key` in `scopes` (innermost first) or `NOT_FOUND`"""
+    return _lookup(key, scopes)[0]
+
+
+def _lookup(key, scopes):
+    """Like `_resolve` but return ``(value, cacheable)``
+
+    Values of providers with a ttl must not be cached by `ScopeChain`.
+    """
+    for scope in scopes:
+        value, cacheable = _lookup_scope(key, scope, scopes)
+        if value is not NOT_FOUND:
+            return value, cacheable
+    return NOT_FOUND, True
+
+
+def _lookup_scope(key, scope, scopes):
+    """`_lookup` in `scope` only, `scopes` is the chain it belongs to"""
+    if key in scope:
+        return scope[key], True
+    elif key in scope._provider:
+        if key in scope._provider_ttl:
+            return _provide_ttl(scope, key), False
+        return _provide_memoized(scope, key), True
+    elif key in scope._subscopes:
+        return SubScopeView(key, scopes), True
+    return NOT_FOUND, True
+
+
+def _provide(provider):
+    value = provider()
+    if gen.is_future(value) or _isawaitable(value):
+        value = gen.convert_yielded(value)
+        _PROVIDED_FUTURES.add(value)
+    return value
+
+
+def _provide_memoized(scope, key):
+    provider = scope._provider[key]
+    value = _provide(provider)
+    scope[key] = value
+    del scope._provider[key]
+    if is_provided_future(value):
+        def forget_failed(future):
+            # restore the provider to run it again on next use
+            # instead of keeping the error for the life of the scope
+            if future.exception() is not None and key in scope and scope[key] is future:
+                scope._provider.setdefault(key, provider)
+                del scope[key]
+        value.add_done_callback(forget_failed)
+    return value
+
+
+def _provide_ttl(scope, key):
+    now = time.time()
+    provided = scope._provided.get(key)
+    if provided is not None and provided[0] > now:
+        return provided[1]
+    value = _provide(scope._provider[key])
+    scope._provided[key] = (now + scope._provider_ttl[key], value)
+    if is_provided_future(value):
+        def forget_failed(future):
+            # run the provider again on next use instead of caching the error
+            if future.exception() is not None and scope._provided.get(key, (0, None))[1] is future:
+                del scope._provided[key]
+        value.add_done_callback(forget_failed)
+    return value
+
+
+def _isawaitable(value):
+    isawaitable = getattr(inspect, 'isawaitable', None)  # python >= 3.5
+    return isawaitable is not None and isawaitable(value)
+
+
+def is_provided_future(value):
+    """True if `value` is a future returned from a coroutine provider"""
+    try:
+        return value in _PROVIDED_FUTURES
+    except TypeError:
+        # not weak referenceable
+        return False
 
 
 class SubScope(Scope):
@@ -119,56 +485,124 @@ class SubScopeView(object):
         )
 
 
-@contextlib.contextmanager
+class _ChainContext(object):
+    """Context manager making `chain` (or the current chain with
+    `scope` pushed) the current `ScopeChain`
+
+    A plain class instead of `contextlib.contextmanager` as
+    ``StackContext`` enters it again for every callback.
+    """
+    __slots__ = ('chain', 'scope', 'previous')
+
+    def __init__(self, chain, scope=None):
+        self.chain = chain
+        self.scope = scope
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = _CURRENT_CHAIN.get()
+        if self.scope is None:
+            _CURRENT_CHAIN.set(self.chain)
+        else:
+            _CURRENT_CHAIN.set(self.previous.push(self.scope))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # set instead of resetting a token, the context we are
+        # leaving in might be a copy of the one we entered in
+        _CURRENT_CHAIN.set(self.previous)
+
+
 def set_context(scope):
-    global SCOPE_CHAIN
-    if SCOPE_CHAIN is None:
-        SCOPE_CHAIN = []
-    SCOPE_CHAIN.append(scope)
-    try:
-        yield
-    finally:
-        # TODO write unit test to get current_scope to be None
-        SCOPE_CHAIN.pop()
+    """Context manager entering `scope` on top of the current chain"""
+    return _ChainContext(None, scope)
+
+
+def chain_context(chain):
+    """Make `chain` the current `ScopeChain`, e.g. inside another thread
+
+    Example usage::
+
+        chain = rw.scope.get_chain()
+
+        def in_thread():
+            with rw.scope.chain_context(chain):
+                ...
+    """
+    return _ChainContext(chain)
 
 
 def get_current_scope():
-    return SCOPE_CHAIN[-1] if SCOPE_CHAIN else None
+    scopes = get_chain().scopes
+    return scopes[-1] if scopes else None
 
 
 def get(key, default=NOT_PROVIDED):
-    if not SCOPE_CHAIN:
+    chain = get_chain()
+    if not chain.scopes:
         raise OutsideScopeError()
-    return SCOPE_CHAIN[-1].get(key, default, list(reversed(SCOPE_CHAIN)))
+    if key == 'scope':
+        return chain.scopes[-1]
+
+    value = chain.lookup(key)
+    if value is not NOT_FOUND:
+        return value
+
+    if default is not NOT_PROVIDED:
+        return default
+
+    msg = 'No value for "{}" stored and no default given'.format(key)
+    raise IndexError(msg)
 
 
 def inject(fn):
+    """Decorator injecting missing arguments of `fn` from the current scope
+
+    The signature of `fn` is inspected once, here.  For every number of
+    positional arguments the names left for injection are precomputed,
+    so a call only does one lookup per missing argument.
+    """
     fn_inspect = getattr(fn, '_rw_wrapped_function', fn)
     arg_spec = inspect.getargspec(fn_inspect)
+    names = tuple(arg_spec.args)
+
+    if not names:
+        # nothing to inject
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return fn(*args, **kwargs)
+        wrapper._rw_injected_function = fn
+        return wrapper
+
+    # injectable[i]: names to inject if called with i positional arguments
+    injectable = [names[i:] for i in range(len(names))]
+    required = frozenset(names[:len(names) - len(arg_spec.defaults or ())])
+    arg_count = len(names)
 
     @functools.wraps(fn)
     def wrapper(*args, **kwargs):
-        if len(args) < len(arg_spec.args):
+        if len(args) < arg_count:
             # possible injection
-            missing_args = set(arg_spec.args[len(args):])
-            for key in missing_args:
+            chain = None
+            for key in injectable[len(args)]:
                 if key not in kwargs:
-                    if not SCOPE_CHAIN:
-                        raise OutsideScopeError('Cannot use inject outside of scope')
-                    try:
-                        kwargs[key] = get(key)
-                    except IndexError:
-                        # the key might not be inside scope but there might be
-                        # a default parameter defined inside the function
-                        pass
-
-        try:
-            return fn(*args, **kwargs)
-        except:
-            msg = 'Error injecting into {}.{}'
-            print(msg.format(fn.__module__, fn.__name__), file=sys.stderr)
-            raise
-
+                    if chain is None:
+                        chain = get_chain()
+                        if not chain.scopes:
+                            raise OutsideScopeError('Cannot use inject outside of scope')
+                    if key == 'scope':
+                        kwargs[key] = chain.scopes[-1]
+                        continue
+                    value = chain.lookup(key)
+                    if value is not NOT_FOUND:
+                        kwargs[key] = value
+                    elif key in required:
+                        # keys with a default parameter defined inside
+                        # the function do not need to be inside scope
+                        msg = '{}.{}: No value for "{}" in scope'
+                        raise TypeError(msg.format(fn.__module__, fn.__name__, key))
+        return fn(*args, **kwargs)
+
+    wrapper._rw_injected_function = fn
     return wrapper
 
 
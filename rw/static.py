@@ -169,7 +169,10 @@ def init(scope, app, settings):
             full_path = pkg_resources.resource_filename(module_name, path)
             full_paths.append(full_path)
 
-        app.root.mount('/' + base_uri + '/<h>/<path:path>',
+        roots = [app.root]
+        roots.extend(module for module in app.hosts.values() if module is not app.root)
+        for root in roots:
+            root.mount('/' + base_uri + '/<h>/<path:path>',
                        StaticHandler, {'path': full_paths},
                        name='static_' + base_uri.replace('.', '_'))
 
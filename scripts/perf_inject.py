@@ -0,0 +1,92 @@
+"""Benchmark rw.scope.inject against the previous, uncompiled implementation"""
+from __future__ import absolute_import, division, print_function, with_statement
+
+import sys
+import timeit
+import inspect
+import functools
+
+import rw.scope
+
+CALLS = 200000
+
+
+def legacy_get(key):
+    """rw.scope.get before lookups were cached
+
+    Copied from the original implementation: every call walks the whole
+    scope chain.  Only fetching the chain uses the current `rw.scope.get_chain`.
+    """
+    scope_chain = rw.scope.get_chain().scopes
+    if not scope_chain:
+        raise rw.scope.OutsideScopeError()
+    scopes = list(reversed(scope_chain))
+    if key == 'scope':
+        return scopes[0]
+
+    for scope in scopes:
+        if key in scope:
+            return scope[key]
+        elif key in scope._provider:
+            scope[key] = scope._provider[key]()
+            del scope._provider[key]
+            return scope[key]
+        elif key in scope._subscopes:
+            return rw.scope.SubScopeView(key, scopes)
+
+    msg = 'No value for "{}" stored and no default given'.format(key)
+    raise IndexError(msg)
+
+
+def legacy_inject(fn):
+    """rw.scope.inject before wrappers were specialized at decoration time"""
+    fn_inspect = getattr(fn, '_rw_wrapped_function', fn)
+    arg_spec = inspect.getargspec(fn_inspect)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if len(args) < len(arg_spec.args):
+            missing_args = set(arg_spec.args[len(args):])
+            for key in missing_args:
+                if key not in kwargs:
+                    if not rw.scope.get_chain().scopes:
+                        raise rw.scope.OutsideScopeError('Cannot use inject outside of scope')
+                    try:
+                        kwargs[key] = legacy_get(key)
+                    except IndexError:
+                        pass
+        try:
+            return fn(*args, **kwargs)
+        except:
+            print('Error injecting', file=sys.stderr)
+            raise
+
+    return wrapper
+
+
+def handler_function(handler, template_env, settings, name='default'):
+    return name
+
+
+def main():
+    app_scope = rw.scope.Scope()
+    app_scope['template_env'] = object()
+    app_scope['settings'] = {}
+    request_scope = rw.scope.Scope()
+    request_scope['handler'] = object()
+
+    legacy = legacy_inject(handler_function)
+    compiled = rw.scope.inject(handler_function)
+
+    with app_scope():
+        with request_scope():
+            for label, fn in (('legacy inject', legacy), ('compiled inject', compiled)):
+                for args, kwargs in (((), {}), (('handler',), {'name': 'x'})):
+                    duration = timeit.timeit(lambda: fn(*args, **kwargs), number=CALLS)
+                    print('{:16} {:12} {:8.3f} us/call'.format(
+                        label, '{} args'.format(len(args) + len(kwargs)),
+                        duration / CALLS * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Startup benchmark: sort 10k routes by precedence
+
+Compares the precomputed `Route.sort_key` with the comparison
+`Route.__lt__` used to do (rebuilding the sort structure per call).
+"""
+from __future__ import absolute_import, division, print_function, with_statement
+
+import functools
+import random
+import time
+
+import rw.routing
+
+ROUTES = 10000
+
+
+def legacy_cmp(rule, other):
+    """comparison as done by Route.__lt__ before sort keys were precomputed"""
+    def sort_struct(route):
+        variables = [part[0] for part in route.route if part[0] is not None]
+        strings = [part[2] for part in route.route if part[0] is None]
+        return variables, strings
+
+    def lt(route, o):
+        if route == o:
+            return False
+        variables, strings = sort_struct(route)
+        variables_o, strings_o = sort_struct(o)
+        if len(variables) != len(variables_o):
+            return len(variables) < len(variables_o)
+        if len(''.join(strings)) != len(''.join(strings_o)):
+            return len(''.join(strings)) > len(''.join(strings_o))
+        for i in range(min(len(strings), len(strings_o))):
+            if strings[i] != strings_o[i]:
+                return strings[i] < strings_o[i]
+        for i in range(len(variables)):
+            if variables[i] != 'str' and variables_o[i] == 'str':
+                return True
+        return False
+
+    if lt(rule, other):
+        return -1
+    if lt(other, rule):
+        return 1
+    return 0
+
+
+def generate_paths(count):
+    random.seed(42)
+    converters = ['', ':int', ':uint', ':path']
+    paths = []
+    for i in range(count):
+        parts = []
+        for depth in range(random.randint(1, 5)):
+            if random.random() < 0.3:
+                parts.append('<var{}{}>'.format(depth, random.choice(converters)))
+            else:
+                parts.append('segment{}'.format(random.randint(0, 50)))
+        paths.append('/' + '/'.join(parts) + '/{}'.format(i))
+    return paths
+
+
+def measure(label, func):
+    start = time.time()
+    func()
+    duration = time.time() - start
+    print('{:30} {:8.3f} s'.format(label, duration))
+    return duration
+
+
+def main():
+    paths = generate_paths(ROUTES)
+    routes = []
+    measure('parse {} routes'.format(ROUTES),
+            lambda: routes.extend(rw.routing.Route(path) for path in paths))
+
+    legacy = measure('sort (legacy comparison)',
+                     lambda: sorted(routes, key=functools.cmp_to_key(legacy_cmp)))
+    current = measure('sort (precomputed sort_key)',
+                      lambda: sorted(routes, key=lambda route: route.sort_key))
+    print('speedup: {:.1f}x'.format(legacy / current))
+
+    rt = rw.routing.RoutingTable('bench')
+    for path in paths:
+        rt.add_route('get', path, None, lambda: None)
+    converters = {
+        'str': rw.routing.converter_default,
+        'int': rw.routing.converter_int,
+        'uint': rw.routing.converter_uint,
+        'path': rw.routing.converter_path,
+    }
+    measure('RoutingTable.setup', lambda: rt.setup(converters))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Benchmark scope propagation through coroutines
+
+Every simulated request enters a request scope inside the application
+scope, yields to the IOLoop a few times and looks up some values.
+With tornado < 6 the scopes are re-entered through ``StackContext``
+on every callback.
+"""
+from __future__ import absolute_import, division, print_function, with_statement
+
+import time
+
+from tornado import gen, ioloop
+
+import rw.scope
+
+REQUESTS = 3000
+YIELDS = 5
+REPEAT = 7
+
+# rw.scope.Scope before the slotted request scope was added
+RequestScope = getattr(rw.scope, 'RequestScope', rw.scope.Scope)
+
+
+@gen.coroutine
+def handle():
+    for _ in range(YIELDS):
+        yield gen.moment
+    rw.scope.get('settings')
+    rw.scope.get('handler')
+    rw.scope.get('template_env')
+
+
+@gen.coroutine
+def requests():
+    for _ in range(REQUESTS):
+        request_scope = RequestScope()
+        request_scope['handler'] = object()
+        with request_scope():
+            future = handle()
+        yield future
+
+
+def main():
+    app_scope = rw.scope.Scope()
+    app_scope['settings'] = {}
+    app_scope['template_env'] = object()
+
+    @gen.coroutine
+    def run():
+        with app_scope():
+            future = requests()
+        yield future
+
+    durations = []
+    for _ in range(REPEAT):
+        start = time.time()
+        ioloop.IOLoop.current().run_sync(run)
+        durations.append(time.time() - start)
+    print('{:8.1f} us/request (best of {})'.format(min(durations) / REQUESTS * 1e6, REPEAT))
+
+
+if __name__ == '__main__':
+    main()
@@ -57,7 +57,8 @@ setup(
                       'chardet',
                       'pytz',
                       'PyYAML>=3.10',
-                      'future'
+                      'future',
+                      'futures; python_version < "3"'
                       ],
     extras_requires={
         'test': ['tox', 'pytest', 'pep8'],
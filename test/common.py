@@ -1,3 +1,7 @@
+import rw.server
+import rw.testing
+
+
 def generate_route_func(name):
     def f(x):
         return x
@@ -11,3 +15,20 @@ def generate_handler_func(route_func, path, name=None):
         name = route_func.__name__ + '_' + {'/': 'index'}[path]
     f = generate_route_func(name)
     return route_func(path)(f)
+
+
+def unregister(app):
+    """Stop configuring `app` on later `rw.server.start` calls"""
+    rw.server.PHASE_CONFIGURATION.discard(app.configure)
+    rw.server.PHASE_SETUP.discard(app.setup)
+
+
+class UnregisterAppMixin(object):
+    """Unregister the application of a HTTP test case after every test"""
+    def tearDown(self):
+        super(UnregisterAppMixin, self).tearDown()
+        unregister(self._app)
+
+
+class AsyncHTTPTestCase(UnregisterAppMixin, rw.testing.AsyncHTTPTestCase):
+    pass
@@ -3,6 +3,7 @@
 """
 import os
 import time
+import threading
 
 import tornado.web
 import tornado.ioloop
@@ -69,6 +70,77 @@ def put(handler):
     handler.finish('put')
 
 
+@root.post('/upload', max_body_size=1024)
+def upload(handler):
+    return 'received {} bytes'.format(len(handler.request.body))
+
+
+@root.get('/bulk')
+def bulk(handler):
+    handler.write('head ')
+    handler.write(memoryview(b'x' * 100000))
+    handler.write(bytearray(b' tail'))
+    handler.finish(u' \u2713')
+
+
+@root.get('/bulk_flushed')
+@gen.coroutine
+def bulk_flushed(handler):
+    for i in range(3):
+        handler.write(memoryview(b'x' * 100000))
+        handler.write('{}'.format(i))
+        yield handler.flush()
+    handler.finish()
+
+
+@root.get('/etag/fast', etag='fast')
+def etag_fast():
+    return 'fast'
+
+
+@root.get('/etag/off', etag='off')
+def etag_off():
+    return 'off'
+
+
+ARTICLE_RENDERS = []
+
+
+@root.get('/article')
+def article(handler):
+    if handler.check_version(7):
+        return
+    ARTICLE_RENDERS.append(1)
+    return 'article version 7'
+
+
+@root.post('/form')
+def form(handler):
+    photo = handler.request.files['photo'][0]
+    return '{} {} {}'.format(handler.get_argument('title'), photo.filename, len(photo.body))
+
+
+@root.post('/stream', stream=2)
+@gen.coroutine
+def stream(handler, body_stream):
+    size = 0
+    while True:
+        chunk = yield body_stream.read()
+        if not chunk:
+            break
+        size += len(chunk)
+    handler.finish('streamed {} bytes'.format(size))
+
+
+@root.post('/stream_forbidden', stream=1)
+@gen.coroutine
+def stream_forbidden(handler, body_stream):
+    # answer before the rest of the body is received
+    yield body_stream.read()
+    handler.set_status(403)
+    handler.finish()
+
+
 @root.delete('/delete')
 def delete(handler):
     handler.finish('delete')
@@ -79,6 +151,63 @@ def options(handler):
     handler.finish('options')
 
 
+CACHED_CALLS = []
+
+
+@root.get('/cached', cache=60)
+def cached():
+    # responses are cached for 60 seconds, see rw.cache
+    CACHED_CALLS.append(1)
+    return 'called {} times'.format(len(CACHED_CALLS))
+
+
+@root.get('/cached_bulk', cache=60, etag='fast')
+def cached_bulk(handler):
+    handler.write(memoryview(b'x' * 100000))
+    handler.finish(bytearray(b' tail'))
+
+
+COALESCED_CALLS = []
+
+
+@root.get('/coalesced', coalesce=True)
+@gen.coroutine
+def coalesced(handler):
+    # identical requests arriving while this one is running
+    # get the same response
+    COALESCED_CALLS.append(1)
+    yield gen.sleep(0.05)
+    handler.finish('called {} times'.format(len(COALESCED_CALLS)))
+
+
+@root.get('/coalesced_article', coalesce=True)
+@gen.coroutine
+def coalesced_article(handler):
+    yield gen.sleep(0.05)
+    if handler.check_version(7):
+        return
+    handler.finish('article version 7')
+
+
+@root.get('/blocking/<name>', executor=True)
+def blocking(name, module):
+    # runs inside the thread pool but scope is still available
+    in_thread = threading.current_thread().name != 'MainThread'
+    return '{} {} {}'.format(name, module.name, in_thread)
+
+
+def require_key(call_next, handler):
+    # middleware only running for routes it is attached to
+    if handler.get_argument('key', None) != 'secret':
+        raise tornado.web.HTTPError(403)
+    return call_next()
+
+
+@root.get('/admin', middleware=[require_key])
+def admin():
+    return 'admin area'
+
+
 @root.get('/foo')
 def some_page():
     return root.render_template('index.html')
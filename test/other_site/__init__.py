@@ -0,0 +1,25 @@
+"""A second site served as virtual host next to `test.example`"""
+import rw.http
+
+root = rw.http.Module('test.other_site')
+
+
+@root.init
+def init(template_env):
+    template_env.globals['site_name'] = 'Other Site'
+
+
+@root.get('/')
+def index():
+    return 'Other Site'
+
+
+@root.get('/user/<name>')
+def user(name):
+    return rw.http.url_for('.user', name=name)
+
+
+@root.get('/page')
+def page(handler):
+    handler['title'] = 'Page'
+    return root.render_template('page.html')
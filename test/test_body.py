@@ -0,0 +1,168 @@
+import pytest
+import tornado.httputil
+import tornado.testing
+from tornado import iostream
+
+import rw.body
+import rw.httpbase
+
+
+class BodyStreamTest(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    def test_flow_control(self):
+        stream = rw.body.BodyStream(maxsize=1)
+        assert stream.feed(b'a').done()
+        # the buffer is full, the connection must wait for the reader
+        waiting = stream.feed(b'b')
+        assert not waiting.done()
+        assert (yield stream.read()) == b'a'
+        yield waiting
+        stream.close()
+        assert (yield stream.read()) == b'b'
+        assert (yield stream.read()) == b''
+        assert (yield stream.read()) == b''
+
+    @tornado.testing.gen_test
+    def test_abort(self):
+        stream = rw.body.BodyStream()
+        reading = stream.read()
+        stream.abort()
+        with pytest.raises(iostream.StreamClosedError):
+            yield reading
+        with pytest.raises(iostream.StreamClosedError):
+            yield stream.read()
+
+    @tornado.testing.gen_test
+    def test_abort_releases_feed(self):
+        stream = rw.body.BodyStream(maxsize=1)
+        stream.feed(b'a')
+        waiting = stream.feed(b'b')
+        stream.abort()
+        yield waiting
+        assert stream.feed(b'c').done()
+        with pytest.raises(iostream.StreamClosedError):
+            yield stream.read()
+
+    @tornado.testing.gen_test
+    def test_abort_complete(self):
+        stream = rw.body.BodyStream()
+        stream.feed(b'a')
+        stream.close()
+        stream.abort()
+        assert (yield stream.read()) == b'a'
+        assert (yield stream.read()) == b''
+
+
+MULTIPART_BODY = (
+    b'--1234\r\n'
+    b'Content-Disposition: form-data; name="title"\r\n'
+    b'\r\n'
+    b'Holiday\r\n'
+    b'--1234\r\n'
+    b'Content-Disposition: form-data; name="photo"; filename="beach.jpg"\r\n'
+    b'Content-Type: image/jpeg\r\n'
+    b'\r\n'
+    b'\r\n--123 not the boundary\r\n'
+    b'--1234--\r\n'
+)
+
+
+def request(content_type):
+    return tornado.httputil.HTTPServerRequest(
+        method='POST', uri='/',
+        headers=tornado.httputil.HTTPHeaders({'Content-Type': content_type}))
+
+
+def test_spooled_body():
+    small = request('application/x-www-form-urlencoded')
+    reader = rw.body.create_reader(small, {'spool_threshold': 10})
+    reader.feed(b'a=1')
+    reader.feed(b'&b=2')
+    reader.finish(small)
+    assert small.body == b'a=1&b=2'
+    assert small.body_file is None
+    assert small.arguments == {'a': [b'1'], 'b': [b'2']}
+
+    large = request('application/octet-stream')
+    reader = rw.body.create_reader(large, {'spool_threshold': 10})
+    reader.feed(b'x' * 8)
+    reader.feed(b'y' * 8)
+    reader.finish(large)
+    assert large.body == b''
+    assert large.body_file.read() == b'x' * 8 + b'y' * 8
+
+
+def test_spooled_form_body():
+    headers = tornado.httputil.HTTPHeaders({'Content-Type': 'application/x-www-form-urlencoded'})
+    req = rw.httpbase.Request(method='POST', uri='/', headers=headers)
+    reader = rw.body.create_reader(req, {'spool_threshold': 4})
+    reader.feed(b'a=1&b=2')
+    reader.finish(req)
+    assert req.body_file is not None
+    assert req.body == b'a=1&b=2'
+    assert req.arguments == {'a': [b'1'], 'b': [b'2']}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, len(MULTIPART_BODY)])
+def test_multipart(chunk_size):
+    req = request('multipart/form-data; boundary=1234')
+    parser = rw.body.create_reader(req, {})
+    assert isinstance(parser, rw.body.MultipartParser)
+    for i in range(0, len(MULTIPART_BODY), chunk_size):
+        parser.feed(MULTIPART_BODY[i:i + chunk_size])
+    parser.finish(req)
+
+    arguments, files = {}, {}
+    tornado.httputil.parse_multipart_form_data(b'1234', MULTIPART_BODY, arguments, files)
+    assert req.body_arguments == arguments
+    assert req.arguments == arguments
+    photo = req.files['photo'][0]
+    assert photo.filename == 'beach.jpg'
+    assert photo.content_type == 'image/jpeg'
+    assert photo.body == files['photo'][0].body == b'\r\n--123 not the boundary'
+    # dict style access of tornado.httputil.HTTPFile
+    assert req.files['photo'][0]['body'] == photo.body
+    assert photo.get('body') == photo.body
+    assert photo['filename'] == 'beach.jpg'
+    # small enough to keep the raw body as well
+    assert req.body == MULTIPART_BODY
+
+
+def test_multipart_large_body():
+    req = request('multipart/form-data; boundary=1234')
+    parser = rw.body.create_reader(req, {'spool_threshold': len(MULTIPART_BODY) - 1})
+    parser.feed(MULTIPART_BODY)
+    parser.finish(req)
+    assert req.body == b''
+    assert req.files['photo'][0].body == b'\r\n--123 not the boundary'
+
+
+def test_close_files():
+    headers = tornado.httputil.HTTPHeaders({'Content-Type': 'multipart/form-data; boundary=1234'})
+    req = rw.httpbase.Request(method='POST', uri='/', headers=headers)
+    parser = rw.body.create_reader(req, {})
+    parser.feed(MULTIPART_BODY)
+    parser.finish(req)
+    photo = req.files['photo'][0]
+    req._close_files()
+    assert photo.file.closed
+
+    headers = tornado.httputil.HTTPHeaders({'Content-Type': 'application/octet-stream'})
+    req = rw.httpbase.Request(method='POST', uri='/', headers=headers)
+    reader = rw.body.create_reader(req, {'spool_threshold': 4})
+    reader.feed(b'x' * 8)
+    reader.finish(req)
+    req._close_files()
+    assert req.body_file.closed
+
+
+@pytest.mark.parametrize('headers', [b'no colon', b'Content-Disposition: \xff\xfe'])
+def test_multipart_invalid_headers(headers):
+    req = request('multipart/form-data; boundary=1234')
+    parser = rw.body.create_reader(req, {})
+    invalid_part = b'--1234\r\n' + headers + b'\r\n\r\nx\r\n--1234--'
+    parser.feed(MULTIPART_BODY.replace(b'--1234--', invalid_part))
+    parser.finish(req)
+    # fields before the invalid part are kept
+    assert req.arguments == {'title': [b'Holiday']}
+    assert list(req.files) == ['photo']
@@ -0,0 +1,79 @@
+import pytest
+import tornado.httputil
+import tornado.util
+
+import rw.cache
+
+
+def test_policy_create():
+    assert rw.cache.CachePolicy.create(None) is None
+    assert rw.cache.CachePolicy.create(False) is None
+    assert rw.cache.CachePolicy.create(True).ttl == 60
+    assert rw.cache.CachePolicy.create(10).ttl == 10
+    policy = rw.cache.CachePolicy.create({'ttl': 5, 'vary': ['Accept-Language']})
+    assert policy.ttl == 5
+    assert policy.vary == ('Accept-Language',)
+
+
+def test_policy_key():
+    request = tornado.httputil.HTTPServerRequest(
+        method='GET', uri='/feed?page=2',
+        headers=tornado.httputil.HTTPHeaders({'Accept-Language': 'de'}))
+    assert rw.cache.CachePolicy(vary=['Accept-Language']).key(request) == \
+        ('/feed', 'page=2', ('de',))
+    assert rw.cache.CachePolicy(query=False).key(request) == ('/feed', '', ())
+
+
+def test_response_cache():
+    headers = tornado.httputil.HTTPHeaders()
+    cache = rw.cache.ResponseCache(max_bytes=250)
+    cache.put('a', 200, headers, b'a' * 100, 60)
+    cache.put('b', 200, headers, b'b' * 100, 60)
+    assert cache.get('a').body == b'a' * 100
+    assert (cache.hits, cache.misses) == (1, 0)
+
+    # exceeding the byte budget evicts the least recently used entry
+    cache.put('c', 200, headers, b'c' * 100, 60)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.size == 200
+
+    # too big to be cached at all
+    cache.put('d', 200, headers, b'd' * 300, 60)
+    assert cache.get('d') is None
+
+    # expired entries are dropped
+    cache.put('e', 200, headers, b'', -1)
+    assert cache.get('e') is None
+    assert len(cache) == 2
+
+
+def test_coalescer():
+    coalescer = rw.cache.Coalescer()
+    assert coalescer.join('a') is None
+    waiting = coalescer.join('a')
+    assert not waiting.done()
+    assert coalescer.coalesced == 1
+
+    coalescer.resolve('a', 200, {}, b'body')
+    assert waiting.result() == (200, {}, b'body')
+    assert len(coalescer) == 0
+    # next request leads again
+    assert coalescer.join('a') is None
+
+
+def test_etag_strategies():
+    parts = [b'Hello ', b'World']
+    if tornado.util.PY3:
+        # RequestHandler.write only buffers memoryviews on Python 3
+        parts[1] = memoryview(parts[1])
+    assert rw.cache.etag_sha1(parts) == rw.cache.etag_sha1([b'Hello World'])
+    assert rw.cache.etag_fast(parts) == rw.cache.etag_fast([b'Hello World'])
+    assert rw.cache.etag_fast(parts) != rw.cache.etag_fast([b'Hello world'])
+    assert rw.cache.etag_fast(parts).startswith('"b-')
+    assert rw.cache.etag_version(3) == 'W/"3"'
+
+    assert rw.cache.check_etag_strategy('fast') == 'fast'
+    assert rw.cache.check_etag_strategy(None) is None
+    with pytest.raises(ValueError):
+        rw.cache.check_etag_strategy('md5')
@@ -4,11 +4,12 @@ import tempfile
 import imp
 import shutil
 
-import rw.testing
 import rw.cli
 
+from .common import AsyncHTTPTestCase
 
-class HTTPServerTest(rw.testing.AsyncHTTPTestCase):
+
+class HTTPServerTest(AsyncHTTPTestCase):
     def get_app(self):
         self.tmp = tempfile.mkdtemp()
         rw.cli.create_skel('skel', self.tmp + '/rwtest', {'name': 'rwtest'})
@@ -80,3 +80,17 @@ class MyTestCase(tornado.testing.AsyncTestCase):
 
         with pytest.raises(ZeroDivisionError):
             yield MY_EVENT()
+
+    @tornado.testing.gen_test
+    def test_fire(self):
+        MY_EVENT = rw.event.Event('MY_EVENT', sum)
+        assert MY_EVENT.fire() == 0
+
+        # synchronous listeners only: no future
+        MY_EVENT.add(lambda x: x)
+        assert MY_EVENT.fire(2) == 2
+
+        MY_EVENT.add(something_lazy)
+        result = MY_EVENT.fire(3)
+        assert isinstance(result, tornado.gen.Future)
+        assert (yield result) == 6
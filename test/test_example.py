@@ -1,12 +1,24 @@
+import os
 import imp
+import socket
 
 import pkg_resources
-import rw.testing
+import pytest
+from tornado import gen, iostream
+from tornado.httputil import HTTPHeaders
+from tornado.testing import AsyncTestCase, gen_test
+
+import rw.cache
+import rw.http
 
 from . import example
+from . import other_site
+from .common import AsyncHTTPTestCase, unregister
+
+CONFIGS = os.path.join(os.path.dirname(__file__), 'configs')
 
 
-class HTTPServerTest(rw.testing.AsyncHTTPTestCase):
+class HTTPServerTest(AsyncHTTPTestCase):
     def get_app(self):
         return rw.httpbase.Application(root=imp.reload(example).root)
 
@@ -25,7 +37,7 @@ class HTTPServerTest(rw.testing.AsyncHTTPTestCase):
         self.check_path('/user/me', u'Hello me')
         self.check_path('/user/you', u'Hello you')
         self.check_path('/nowhere', code=404)
-        self.check_path('/put', code=404)
+        self.check_path('/put', code=405)
 
     def test_return(self):
         self.check_path('/hello_handler', u'Hello Handler!')
@@ -66,3 +78,252 @@ class HTTPServerTest(rw.testing.AsyncHTTPTestCase):
 
     def test_url_for_inside_submodule(self):
         self.check_path('/sub', '/sub\n/sub')
+
+    def test_response_cache(self):
+        response = self.check_path('/cached', u'called 1 times')
+        self.check_path('/cached', u'called 1 times')
+        # the query string is part of the cache key
+        self.check_path('/cached?page=2', u'called 2 times')
+
+        # cached responses still support ETags
+        etag = response.headers['Etag']
+        response = self.fetch('/cached', headers={'If-None-Match': etag})
+        assert response.code == 304
+
+    def test_response_cache_bulk(self):
+        body = b'x' * 100000 + b' tail'
+        first = self.fetch('/cached_bulk')
+        second = self.fetch('/cached_bulk')
+        assert first.code == second.code == 200
+        assert first.body == second.body == body
+        assert first.headers['Etag'] == second.headers['Etag']
+
+    def test_coalesce(self):
+        responses = []
+
+        def on_response(response):
+            responses.append(response)
+            if len(responses) == 3:
+                self.stop()
+
+        for i in range(3):
+            self.http_client.fetch(self.get_url('/coalesced'), on_response)
+        self.wait()
+        assert [r.body for r in responses] == [b'called 1 times'] * 3
+
+        self.check_path('/coalesced', u'called 2 times')
+
+    def test_coalesce_conditional_leader(self):
+        responses = []
+
+        def on_response(response):
+            responses.append(response)
+            if len(responses) == 2:
+                self.stop()
+
+        # the leader gets 304, the follower has no ETag to compare with
+        self.http_client.fetch(self.get_url('/coalesced_article'), on_response,
+                               headers={'If-None-Match': 'W/"7"'})
+        self.http_client.fetch(self.get_url('/coalesced_article'), on_response)
+        self.wait()
+        responses.sort(key=lambda response: response.code)
+        assert [r.code for r in responses] == [200, 304]
+        assert responses[0].body == b'article version 7'
+
+    def test_middleware(self):
+        self.check_path('/admin', code=403)
+        self.check_path('/admin?key=secret', u'admin area')
+        self.check_path('/', u'Hello World')
+
+    def test_early_reject(self):
+        response = self.check_path('/', method='PATCH', request_body='', code=405)
+        assert response.headers['Allow'] == 'GET, POST'
+        response = self.check_path('/hello_handler', method='POST', request_body='', code=405)
+        assert response.headers['Allow'] == 'GET'
+        self.check_path('/nowhere', method='PATCH', request_body='', code=404)
+        assert 'Allow' not in self.check_path('/').headers
+        self.check_path('/upload', u'received 10 bytes', method='POST', request_body='x' * 10)
+
+    @gen_test
+    def test_early_reject_body_not_read(self):
+        for path, code in ((b'/upload', b'413'), (b'/nowhere', b'404')):
+            stream = iostream.IOStream(socket.socket())
+            yield stream.connect(('127.0.0.1', self.get_http_port()))
+            # the response arrives without sending the announced body
+            yield stream.write(b'POST ' + path + b' HTTP/1.1\r\n'
+                               b'Content-Length: 1000000\r\n\r\n')
+            status_line = yield stream.read_until(b'\r\n')
+            assert status_line.split()[1] == code
+            stream.close()
+
+    @gen_test
+    def test_early_reject_keep_alive(self):
+        stream = iostream.IOStream(socket.socket())
+        yield stream.connect(('127.0.0.1', self.get_http_port()))
+        # requests without body keep the connection open
+        for path, code in ((b'/nowhere', b'404'), (b'/put', b'405'), (b'/', b'200')):
+            yield stream.write(b'GET ' + path + b' HTTP/1.1\r\n\r\n')
+            header_data = yield stream.read_until(b'\r\n\r\n')
+            status_line, header_data = header_data.split(b'\r\n', 1)
+            assert status_line.split()[1] == code
+            headers = HTTPHeaders.parse(header_data.decode('latin1'))
+            yield stream.read_bytes(int(headers['Content-Length']))
+        stream.close()
+
+    def test_stream(self):
+        body = b'x' * 1024 * 1024
+        self.check_path('/stream', u'streamed 1048576 bytes', method='POST', request_body=body)
+
+    @gen_test
+    def test_stream_finished_early(self):
+        stream = iostream.IOStream(socket.socket())
+        yield stream.connect(('127.0.0.1', self.get_http_port()))
+        yield stream.write(b'POST /stream_forbidden HTTP/1.1\r\n'
+                           b'Content-Length: 1048576\r\n\r\n')
+        # more than fits into the body stream's queue
+        stream.write(b'x' * 1024 * 1024)
+        status_line = yield stream.read_until(b'\r\n')
+        assert status_line.split()[1] == b'403'
+        # the server stops waiting for the unread body and closes
+        for _ in range(100):
+            if not self.http_server._connections:
+                break
+            yield gen.sleep(0.01)
+        assert not self.http_server._connections
+        stream.close()
+
+    def test_multipart(self):
+        body = (b'--1234\r\n'
+                b'Content-Disposition: form-data; name="title"\r\n\r\n'
+                b'Holiday\r\n'
+                b'--1234\r\n'
+                b'Content-Disposition: form-data; name="photo"; filename="beach.jpg"\r\n\r\n'
+                + b'x' * 100000 + b'\r\n'
+                b'--1234--\r\n')
+        response = self.fetch('/form', method='POST', body=body,
+                              headers={'Content-Type': 'multipart/form-data; boundary=1234'})
+        assert response.body == b'Holiday beach.jpg 100000'
+
+    def test_write_buffers(self):
+        response = self.fetch('/bulk')
+        body = b'head ' + b'x' * 100000 + b' tail \xe2\x9c\x93'
+        assert response.body == body
+        assert response.headers['Content-Length'] == str(len(body))
+
+        response = self.fetch('/bulk_flushed')
+        assert response.body == b''.join(b'x' * 100000 + str(i).encode() for i in range(3))
+
+    def test_etag(self):
+        response = self.fetch('/etag/fast')
+        assert response.headers['Etag'] == rw.cache.etag_fast([b'fast'])
+        response = self.fetch('/etag/fast', headers={'If-None-Match': response.headers['Etag']})
+        assert response.code == 304
+        assert 'Etag' not in self.fetch('/etag/off').headers
+        # default strategy
+        assert self.fetch('/').headers['Etag'] == rw.cache.etag_sha1([b'Hello World'])
+
+    def test_check_version(self):
+        del example.ARTICLE_RENDERS[:]
+        response = self.fetch('/article')
+        assert response.body == b'article version 7'
+        assert response.headers['Etag'] == 'W/"7"'
+        response = self.fetch('/article', headers={'If-None-Match': 'W/"7"'})
+        assert response.code == 304
+        assert example.ARTICLE_RENDERS == [1]
+
+    def test_executor(self):
+        self.check_path('/blocking/joe', u'joe test.example True')
+        executor = self._app.scope['executor']
+        assert executor.stats()['completed'] == 1
+
+
+class DispatchCacheTest(AsyncHTTPTestCase):
+    """The example app with ``rw.http: dispatch_cache_size`` set"""
+    configs = ['dispatch_cache.yml']
+
+    def get_app(self):
+        configs = [os.path.join(CONFIGS, config) for config in self.configs]
+        return rw.httpbase.Application(root=imp.reload(example).root, extra_configs=configs)
+
+    def check_routing(self):
+        for _ in range(2):
+            assert self.fetch('/').body == b'Hello World'
+            assert self.fetch('/otherplace').body == b'other'
+            assert self.fetch('/user/me').body == b'Hello me'
+            assert self.fetch('/user/you').body == b'Hello you'
+            assert self.fetch('/nowhere').code == 404
+            assert self.fetch('/put').code == 405
+
+    def test_dispatch_cache(self):
+        self.check_routing()
+        routing_table = self._app.scope['rw.http']['routing_table']
+        assert routing_table.cache.hits >= 1
+
+
+class FlatRoutesTest(DispatchCacheTest):
+    """The example app with ``rw.http: flatten_routes`` and the dispatch cache"""
+    configs = ['dispatch_cache.yml', 'flat_routes.yml']
+
+    def test_flat_routes(self):
+        self.check_routing()
+        routing_table = self._app.scope['rw.http']['routing_table']
+        assert all(not sub_rt.tries for _, sub_rt in routing_table.sub_rt)
+
+
+class MaxBodySizeTest(AsyncHTTPTestCase):
+    """The example app with ``rw.http: max_body_size`` set"""
+    def get_app(self):
+        return rw.httpbase.Application(root=imp.reload(example).root,
+                                       extra_configs=os.path.join(CONFIGS, 'max_body_size.yml'))
+
+    @gen_test
+    def test_chunked_stream(self):
+        stream = iostream.IOStream(socket.socket())
+        yield stream.connect(('127.0.0.1', self.get_http_port()))
+        # the chunked body does not announce its size
+        yield stream.write(b'POST /stream HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n')
+        for _ in range(3):
+            yield stream.write(b'400\r\n' + b'x' * 1024 + b'\r\n')
+        yield stream.write(b'0\r\n\r\n')
+        # tornado closes the connection once the limit is exceeded
+        response = yield stream.read_until_close()
+        assert b'streamed' not in response
+
+    def test_small_stream(self):
+        response = self.fetch('/stream', method='POST', body=b'x' * 1000)
+        assert response.body == b'streamed 1000 bytes'
+
+
+class ConfigureTest(AsyncTestCase):
+    @gen_test
+    def test_unknown_etag_strategy(self):
+        app = rw.httpbase.Application(root=imp.reload(example).root)
+        app.scope['settings'].setdefault('rw.http', {})['etag'] = 'md5'
+        try:
+            # fails at startup instead of on every response
+            with pytest.raises(ValueError):
+                yield app.configure()
+        finally:
+            # do not let the broken app fail later rw.server.start() calls
+            unregister(app)
+
+
+class VirtualHostTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return rw.httpbase.Application(root=imp.reload(example).root,
+                                       hosts={'Other.Site': imp.reload(other_site).root})
+
+    def fetch_host(self, path, host):
+        return self.fetch(path, headers={'Host': host})
+
+    def test_hosts(self):
+        assert self.fetch_host('/', 'other.site').body == b'Other Site'
+        assert self.fetch_host('/', 'other.site:8080').body == b'Other Site'
+        assert self.fetch_host('/user/joe', 'other.site').body == b'/user/joe'
+        assert self.fetch_host('/otherplace', 'other.site').code == 404
+        # templates and template globals of the host module
+        assert self.fetch_host('/page', 'other.site').body == b'Page of Other Site at /page'
+
+        # unknown hosts are served by the root module
+        assert self.fetch_host('/', 'example.com').body == b'Hello World'
+        assert self.fetch_host('/otherplace', 'example.com').body == b'other'
@@ -0,0 +1,83 @@
+import time
+import threading
+
+import pytest
+
+import rw.executor
+import rw.routing
+import rw.scope
+
+
+def square(value):
+    return value * value
+
+
+@rw.scope.inject
+def square_route(value):
+    return square(value)
+
+
+@rw.scope.inject
+def handler_route(value, handler):
+    return value
+
+
+def test_scoped_executor():
+    executor = rw.executor.ScopedExecutor(max_workers=1, queue=1)
+    scope = rw.scope.Scope()
+    scope['value'] = 42
+    release = threading.Event()
+
+    try:
+        with scope():
+            blocked = executor.submit(release.wait)
+            # the worker thread must have taken the first call from the queue
+            deadline = time.time() + 5
+            while executor.busy != 1 and time.time() < deadline:
+                time.sleep(0.001)
+            assert executor.busy == 1
+            waiting = executor.submit(rw.scope.get, 'value')
+            # the only thread is busy and one call is waiting already
+            with pytest.raises(rw.executor.QueueFull):
+                executor.submit(rw.scope.get, 'value')
+    finally:
+        release.set()
+
+    assert waiting.result() == 42
+    assert blocked.result() is True
+    assert executor.stats() == {'max_workers': 1, 'queued': 0, 'busy': 0, 'completed': 2}
+    executor.shutdown()
+
+
+def test_process_pool():
+    pool = rw.executor.ProcessPool(max_workers=1)
+    try:
+        assert pool.submit(square, 3).result() == 9
+
+        plan = rw.routing.CallPlan(square_route, ('value',))
+        assert pool.submit_route(plan, {'value': 4}).result() == 16
+    finally:
+        pool.shutdown()
+
+
+def test_check_process_route():
+    rw.executor.check_process_route(rw.routing.CallPlan(square_route, ('value',)))
+
+    # only url variables are passed on to route functions
+    with pytest.raises(ValueError):
+        rw.executor.check_process_route(rw.routing.CallPlan(handler_route, ('value',)))
+
+    # worker processes import the function by its name
+    def nested_route(value):
+        return value
+
+    with pytest.raises(ValueError):
+        rw.executor.check_process_route(rw.routing.CallPlan(nested_route, ('value',)))
+
+
+def test_process_route_setup():
+    rt = rw.routing.RoutingTable('root')
+    rt.add_route('get', '/<value>', 0, handler_route, {'process': True})
+    # fails at startup instead of on the first request
+    with pytest.raises(ValueError):
+        rt.setup({'str': rw.routing.converter_default})
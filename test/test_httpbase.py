@@ -1,17 +1,126 @@
+import pytest
+import tornado.httputil
+import tornado.util
+import tornado.web
+from tornado import concurrent, gen
 from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, ExpectLog, gen_test
 
 import rw.httpbase
 
+from . import common
+
 
 class HelloWorldHandler(rw.httpbase.RequestHandler):
     def handle_request(self):
         self.finish('Hello World')
 
 
-class HTTPServerTest(AsyncHTTPTestCase):
+class HTTPServerTest(common.UnregisterAppMixin, AsyncHTTPTestCase):
     def get_app(self):
         return rw.httpbase.Application(handler=HelloWorldHandler)
 
     def test_hello_world(self):
         response = self.fetch('/')
         assert response.body.decode('utf-8') == u'Hello World'
+
+
+def test_lazy_request_body(monkeypatch):
+    headers = tornado.httputil.HTTPHeaders({'Content-Type': 'application/x-www-form-urlencoded'})
+    request = rw.httpbase.Request(method='POST', uri='/?a=1', body=b'b=2', headers=headers)
+    parsed = []
+    parse_body = tornado.httputil.HTTPServerRequest._parse_body
+
+    def counting_parse_body(self):
+        parsed.append(1)
+        parse_body(self)
+    monkeypatch.setattr(tornado.httputil.HTTPServerRequest, '_parse_body', counting_parse_body)
+
+    request._parse_body()
+    assert parsed == []
+    assert request.arguments == {'a': [b'1'], 'b': [b'2']}
+    assert request.body_arguments == {'b': [b'2']}
+    assert request.query_arguments == {'a': [b'1']}
+    assert parsed == [1]
+
+
+def test_request_json():
+    request = rw.httpbase.Request(method='POST', uri='/', body=b'{"a": [1, 2]}')
+    assert request.json == {'a': [1, 2]}
+    assert request.json is request.json
+
+    request = rw.httpbase.Request(method='POST', uri='/', body=b'{')
+    with pytest.raises(tornado.web.HTTPError):
+        request.json
+
+
+def test_coalesced_write_buffer():
+    handler = HelloWorldHandler.__new__(HelloWorldHandler)
+    handler.write_coalesce_size = 4
+    large = memoryview(b'large')
+    handler._write_buffer = [b'a', b'b', large, b'c', bytearray(b'd')]
+    parts = handler._coalesced_write_buffer()
+    assert parts == [b'ab', large, b'cd']
+    if tornado.util.PY3:
+        # large chunks are not copied
+        assert parts[1] is large
+
+
+class RecordingConnection(object):
+    """HTTP connection completing writes only when told to"""
+    def __init__(self):
+        self.written = []
+        self.writes = []
+        self.finished = False
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write_headers(self, start_line, headers, chunk=None, callback=None):
+        self.written.append(b'headers')
+        if chunk:
+            self.written.append(bytes(chunk))
+        return self._write()
+
+    def write(self, chunk, callback=None):
+        self.written.append(bytes(chunk))
+        return self._write()
+
+    def _write(self):
+        future = concurrent.Future()
+        self.writes.append(future)
+        return future
+
+    def finish(self):
+        self.finished = True
+
+
+class FlushTest(AsyncTestCase):
+    @gen_test
+    def test_parts_written_one_by_one(self):
+        connection = RecordingConnection()
+        request = rw.httpbase.Request(method='POST', uri='/', connection=connection)
+        app = rw.httpbase.Application(handler=HelloWorldHandler)
+        common.unregister(app)
+        handler = HelloWorldHandler(app, request)
+        handler.write_coalesce_size = 4
+        handler.write(b'x' * 10)
+        handler.write(b'y' * 10)
+        flushed = handler.flush()
+        assert connection.written == [b'headers', b'x' * 10]
+
+        for future in connection.writes[:]:
+            future.set_result(None)
+        yield gen.moment
+        # the next part is written once the previous one completed
+        assert connection.written == [b'headers', b'x' * 10, b'y' * 10]
+        assert not flushed.done()
+
+        handler.finish(b'z' * 10)
+        assert not connection.finished
+        while not connection.finished:
+            for future in connection.writes:
+                if not future.done():
+                    future.set_result(None)
+            yield gen.moment
+        assert flushed.done()
+        assert connection.written == [b'headers', b'x' * 10, b'y' * 10, b'z' * 10]
@@ -1,3 +1,5 @@
+import random
+
 import pytest
 import tornado.testing
 
@@ -76,6 +78,7 @@ def test_reverse_path():
     assert generate_rule('/').get_path() == '/'
     assert generate_rule('/somewhere').get_path() == '/somewhere'
     assert generate_rule('/user/<user>').get_path({'user': 'dino'}) == '/user/dino'
+    assert generate_rule('/{x}/<num:int>').get_path({'num': 5}) == '/{x}/5'
 
 
 def test_converter_default():
@@ -147,3 +150,250 @@ class MyTestCase(tornado.testing.AsyncTestCase):
         assert generate_rule('/<foo>').match('/foo/bar') is None
         assert generate_rule('/<foo:path>').match('/foo/bar') == {'foo': 'foo/bar'}
         self.stop()
+
+
+def test_trie_precedence():
+    # the routing trie must return the same result as
+    # matching the sorted routes one by one
+    paths = ['/', '/name', '/na<something>', '/name<something>',
+             '/<something>', '/<something:int>', '/user/<user>',
+             '/user/<user>/photo/<num:int>', '/user/<user>/<rest:path>',
+             '/user/me', '/files/<name:path>']
+    rt = rw.routing.RoutingTable('root')
+    for path in paths:
+        rt.add_route('get', path, 0, generate_route_func(path))
+
+    scope = rw.scope.Scope()
+    scope['rw.routing:converters'] = {
+        'str': rw.routing.converter_default,
+        'int': rw.routing.converter_int,
+        'path': rw.routing.converter_path,
+    }
+    with scope():
+        rt.setup()
+        for path in ['/', '/name', '/names', '/nax', '/12', '/foo', '/user/me',
+                     '/user/joe', '/user/joe/photo/3', '/user/joe/photo/x',
+                     '/files/a/b/c', '/files', '/user/joe/']:
+            expected = None
+            for route, _, _, fn in rt['get']:
+                args = route.match(path)
+                if args is not None:
+                    expected = fn, args
+                    break
+            prefix, module, fn, args = rt.find_route('get', path)
+            if expected is None:
+                assert fn is None
+            else:
+                assert (fn, args) == expected, path
+
+
+def _assert_trie_matches_linear_scan(rt, paths):
+    for path in paths:
+        expected = None
+        for route, _, _, fn in rt['get']:
+            args = route.match(path)
+            if args is not None:
+                expected = fn, args
+                break
+        prefix, module, fn, args = rt.find_route('get', path)
+        if expected is None:
+            assert fn is None, path
+        else:
+            assert (fn, args) == expected, path
+
+
+def test_trie_split_edges():
+    # edges split by later routes must keep the priority of their subtree
+    for routes, path in [(['/<x>/abc', '/<x>/abd', '/qq/<y>'], '/qq/abc'),
+                         (['/<x>/abc', '/qq/<y>', '/<x>/a'], '/qq/abc')]:
+        rt = rw.routing.RoutingTable('root')
+        for route in routes:
+            rt.add_route('get', route, 0, generate_route_func(route))
+        with rw.scope.Scope()():
+            rt.setup({'str': rw.routing.converter_default})
+            _assert_trie_matches_linear_scan(rt, [path])
+
+
+def test_trie_random():
+    rand = random.Random(42)
+
+    def random_path(parts):
+        return '/' + '/'.join(rand.choice(parts).format(i)
+                              for i in range(rand.randint(1, 3)))
+
+    for _ in range(500):
+        rt = rw.routing.RoutingTable('root')
+        for route in set(random_path(['a', 'abc', 'abd', 'qq', '<x{}>', '<y{}:int>'])
+                         for _ in range(6)):
+            rt.add_route('get', route, 0, generate_route_func(route))
+        with rw.scope.Scope()():
+            rt.setup({'str': rw.routing.converter_default,
+                      'int': rw.routing.converter_int})
+            requests = [random_path(['a', 'ab', 'abc', 'abd', 'qq', '12'])
+                        for _ in range(30)]
+            _assert_trie_matches_linear_scan(rt, requests)
+
+
+def test_missing_converter():
+    rt = rw.routing.RoutingTable('root')
+    rt.add_route('get', '/<name:unknown>', 0, generate_route_func('index'))
+    # converters are resolved during setup, not per request
+    with pytest.raises(AttributeError):
+        rt.setup({'str': rw.routing.converter_default})
+
+
+def test_call_plan():
+    @rw.scope.inject
+    def user_page(handler, name, default='default'):
+        return handler, name, default
+
+    plan = rw.routing.CallPlan(user_page, ('name', 'unused'))
+    assert plan.url_args == ('name',)
+    assert plan.scope_args == ('handler', 'default')
+
+    def everything(**kwargs):
+        return kwargs
+
+    plan_kwargs = rw.routing.CallPlan(everything, ('name', 'unused'))
+    assert plan_kwargs.url_args == ('name', 'unused')
+    assert plan_kwargs.scope_args == ()
+
+    scope = rw.scope.Scope()
+    scope['handler'] = 'the handler'
+    with scope():
+        url_variables = {'name': 'joe', 'unused': 1}
+        assert plan(url_variables) == ('the handler', 'joe', 'default')
+        assert plan_kwargs(url_variables) == url_variables
+
+
+def test_dispatch_cache():
+    rt = rw.routing.RoutingTable('root')
+    rt.add_route('get', '/', 0, generate_route_func('index'))
+    rt.enable_cache(2)
+    rt.setup()
+
+    assert rt.find_route('get', '/')[2].__name__ == 'index'
+    assert rt.find_route('get', '/')[2].__name__ == 'index'
+    assert rt.find_route('get', '/nowhere') == (None, None, None, None)
+    assert rt.find_route('get', '/nowhere') == (None, None, None, None)
+    assert (rt.cache.hits, rt.cache.misses) == (2, 2)
+
+    # bounded in size
+    rt.find_route('get', '/somewhere')
+    assert len(rt.cache) == 2
+
+    # changing the routing table invalidates the cache
+    rt.add_route('get', '/nowhere', 0, generate_route_func('nowhere'))
+    rt.setup()
+    assert len(rt.cache) == 0
+    assert rt.find_route('get', '/nowhere')[2].__name__ == 'nowhere'
+
+
+def test_allowed_methods_bypasses_dispatch_cache():
+    rt = rw.routing.RoutingTable('root')
+    rt.add_route('get', '/', 0, generate_route_func('index'))
+    rt.add_route('post', '/', 0, generate_route_func('submit'))
+    rt.add_route('put', '/other', 0, generate_route_func('other'))
+    rt.enable_cache(10)
+    rt.setup()
+
+    assert rt.find_route('get', '/')[2].__name__ == 'index'
+    assert rt.allowed_methods('/') == ['GET', 'POST']
+    assert rt.allowed_methods('/nowhere') == []
+    assert len(rt.cache) == 1
+    assert (rt.cache.hits, rt.cache.misses) == (0, 1)
+
+
+def generate_routing_tables():
+    rt0 = rw.routing.RoutingTable('root')
+    rt0.add_route('get', '/', 0, generate_route_func('index'))
+    rt1 = rw.routing.RoutingTable('sub')
+    rt1.add_route('get', '/', 1, generate_route_func('index'))
+    rt2 = rw.routing.RoutingTable('subsub')
+    rt2.add_route('get', '/', 2, generate_route_func('index'))
+    rt2.add_route('get', '/fun', 2, generate_route_func('fun'))
+    rt0.add_child('/sub', rt1)
+    rt1.add_child('/subsub', rt2)
+    return rt0
+
+
+def test_flatten():
+    nested = generate_routing_tables()
+    nested.setup()
+    flat = generate_routing_tables()
+    flat.setup(flatten=True)
+
+    for path in ['/', '/sub', '/sub/subsub', '/sub/subsub/fun', '/nowhere']:
+        prefix, module, fn, args = nested.find_route('get', path)
+        prefix_flat, module_flat, fn_flat, args_flat = flat.find_route('get', path)
+        assert (prefix, module, args) == (prefix_flat, module_flat, args_flat)
+        assert getattr(fn, '__name__', None) == getattr(fn_flat, '__name__', None)
+
+    assert sorted(nested.fn_namespace) == sorted(flat.fn_namespace)
+    assert flat.fn_namespace['sub.subsub.fun'].rw_route.path == '/sub/subsub/fun'
+
+    # every route exists exactly once
+    assert nested.stats['routes'] == flat.stats['routes'] == 4
+    assert nested.stats['route_objects'] == 9
+    assert flat.stats['route_objects'] == 4
+    assert flat.stats['memory'] < nested.stats['memory']
+
+
+def test_middleware():
+    calls = []
+
+    def middleware(name):
+        def mw(call_next):
+            calls.append(name)
+            return call_next()
+        return mw
+
+    for flatten in (False, True):
+        rt = generate_routing_tables()
+        rt.middleware = (middleware('root'),)
+        rt.sub_rt[0][1].middleware = (middleware('sub'),)
+        rt.sub_rt[0][1].sub_rt[0][1].add_route('get', '/admin', 2, generate_route_func('admin'),
+                                               {'middleware': [middleware('admin')]})
+        rt.setup(flatten=flatten)
+
+        expected = {
+            '/': ['root'],
+            '/sub': ['root', 'sub'],
+            '/sub/subsub/fun': ['root', 'sub'],
+            '/sub/subsub/admin': ['root', 'sub', 'admin'],
+        }
+        for path, names in expected.items():
+            route = rt.resolve('get', path)[0][0]
+            del calls[:]
+            assert route.middleware_chain(lambda: 'result') == 'result'
+            assert calls == names
+
+
+def test_middleware_signature():
+    def broken():
+        pass
+
+    rt = rw.routing.RoutingTable('root')
+    rt.add_route('get', '/', 0, generate_route_func('index'))
+    rt.middleware = (broken,)
+    # fails at startup instead of on the first request
+    with pytest.raises(TypeError):
+        rt.setup({})
+
+
+def test_rule_sort_key():
+    rules = [generate_rule(path) for path in
+             ['/name', '/', '/name/<name>/photo', '/name/<else>', '/<num:int>', '/<something>']]
+    assert sorted(rules, key=lambda rule: rule.sort_key) == rules
+    assert generate_rule('/<a:int>/<b>').sort_key < generate_rule('/<a>/<b>').sort_key
+
+
+def test_get_route():
+    rt = generate_routing_tables()
+    rt.setup()
+    assert rt.get_route('sub.subsub.fun').path == '/sub/subsub/fun'
+    assert rt.get_route('.fun', 'sub.subsub') is rt.get_route('sub.subsub.fun')
+    assert rt.get_route('.index', '') is rt.get_route('index')
+    assert rt.get_route('.nothing', 'sub') is None
+    assert rt.get_path('.nothing', {}, 'sub') == '404'
+    assert ('sub', '.nothing') in rt.named_routes
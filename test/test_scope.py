@@ -1,11 +1,15 @@
 from __future__ import absolute_import, division, print_function, with_statement
 
+import threading
+
 import pytest
 from tornado import concurrent
 
 import tornado.gen
+import tornado.web
 import tornado.testing
 
+import rw.routing
 import rw.scope
 
 
@@ -75,6 +79,135 @@ def test_basic():
         assert bar() == 42
 
 
+def test_chain_view():
+    app_scope = rw.scope.Scope()
+    app_scope['settings'] = {'debug': True}
+    request_scope = rw.scope.Scope()
+    stats = rw.scope.STATS
+
+    with app_scope():
+        with request_scope():
+            assert rw.scope.get('settings') == {'debug': True}
+            hits = stats.hits
+            assert rw.scope.get('settings') == {'debug': True}
+            assert stats.hits == hits + 1
+
+            # writing to any scope invalidates cached values
+            request_scope['settings'] = {'debug': False}
+            assert rw.scope.get('settings') == {'debug': False}
+            del request_scope['settings']
+            assert rw.scope.get('settings') == {'debug': True}
+
+            # so does adding a provider
+            request_scope.provider('settings', lambda: {'provided': True})
+            assert rw.scope.get('settings') == {'provided': True}
+
+            # misses are cached as well
+            assert rw.scope.get('unknown', 'default') == 'default'
+            with pytest.raises(IndexError):
+                rw.scope.get('unknown')
+
+        # leaving a scope restores the previous chain
+        assert rw.scope.get('settings') == {'debug': True}
+    assert rw.scope.get_current_scope() is None
+
+
+def test_chain_view_per_scope():
+    app_scope = rw.scope.Scope()
+    app_scope['settings'] = {'debug': True}
+    stats = rw.scope.STATS
+
+    for i in range(3):
+        # one request scope per request
+        request_scope = rw.scope.RequestScope()
+        with app_scope():
+            with request_scope():
+                request_scope['handler'] = i
+                request_scope['url_variables'] = {}
+                hits = stats.hits
+                assert rw.scope.get('settings') == {'debug': True}
+                if i:
+                    # cached by the chain of the application scope,
+                    # writes to request scopes do not invalidate it
+                    assert stats.hits == hits + 1
+                assert rw.scope.get('handler') == i
+
+    with app_scope():
+        app_scope['settings'] = {'debug': False}
+        with rw.scope.RequestScope()():
+            assert rw.scope.get('settings') == {'debug': False}
+
+
+@pytest.mark.parametrize('fallback', [False, True])
+def test_chain_other_thread(monkeypatch, fallback):
+    if fallback or rw.scope.contextvars is None:
+        var = rw.scope._ThreadLocalVar('rw.scope.chain', rw.scope.EMPTY_CHAIN)
+        monkeypatch.setattr(rw.scope, '_CURRENT_CHAIN', var)
+        monkeypatch.setattr(rw.scope, 'get_chain', var.get)
+    scope = rw.scope.Scope()
+    scope['value'] = 42
+    results = []
+
+    def in_thread(chain):
+        results.append(rw.scope.get_current_scope())
+        with rw.scope.chain_context(chain):
+            results.append(rw.scope.get('value'))
+        results.append(rw.scope.get_current_scope())
+
+    with scope():
+        thread = threading.Thread(target=in_thread, args=(rw.scope.get_chain(),))
+        thread.start()
+        thread.join()
+        # the thread did not change the chain of this thread
+        assert rw.scope.get_current_scope() is scope
+
+    assert results == [None, 42, None]
+
+
+def test_without_stack_context(monkeypatch):
+    # tornado >= 6 does not provide stack_context,
+    # the chain is then only carried by the context variable
+    monkeypatch.setattr(rw.scope, 'stack_context', None)
+    scope = rw.scope.Scope()
+    scope['value'] = 42
+    request_scope = rw.scope.RequestScope()
+    request_scope['user'] = 'joe'
+    results = []
+
+    @tornado.gen.coroutine
+    def target():
+        results.append((rw.scope.get_current_scope(), rw.scope.get('value')))
+
+    with scope():
+        assert rw.scope.get_current_scope() is scope
+        with request_scope():
+            assert rw.scope.get('user') == 'joe'
+            assert rw.scope.get('value') == 42
+        assert rw.scope.get_current_scope() is scope
+    assert rw.scope.get_current_scope() is None
+
+    scope.run(target).result()
+    assert results == [(scope, 42)]
+    assert rw.scope.get_current_scope() is None
+
+
+def test_thread_local_fallback():
+    var = rw.scope._ThreadLocalVar('test', 'default')
+    var.set('main')
+    results = []
+
+    def in_thread():
+        results.append(var.get())
+        var.set('thread')
+        results.append(var.get())
+
+    thread = threading.Thread(target=in_thread)
+    thread.start()
+    thread.join()
+    assert results == ['default', 'thread']
+    assert var.get() == 'main'
+
+
 def test_recursion():
     """Entering the same scope twice should not produce unexpected behaviour"""
     scope = rw.scope.Scope()
@@ -157,6 +290,27 @@ def test_fail():
     foo(something_to_inject=1)
 
 
+def test_inject_compiled():
+    @rw.scope.inject
+    def no_arguments():
+        return 'called'
+
+    @rw.scope.inject
+    def needs_value(value):
+        return value
+
+    @rw.scope.inject
+    def current_scope(scope):
+        return scope
+
+    assert no_arguments() == 'called'
+    scope = rw.scope.Scope()
+    with scope():
+        assert current_scope() is scope
+        with pytest.raises(TypeError):
+            needs_value()
+
+
 class ScopeLeakingTest(tornado.testing.AsyncTestCase):
     def test_scope_leaking(self):
         # if an exception ocurus inside a scope the scope might not
@@ -264,3 +418,128 @@ class ConcurrencyTest(tornado.testing.AsyncTestCase):
 
         self.lock_b.set_result(None)
         assert (yield future_b) == 'b'
+
+
+def test_provider_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rw.scope.time, 'time', lambda: now[0])
+    calls = []
+
+    def counter():
+        calls.append(1)
+        return len(calls)
+
+    scope = rw.scope.Scope()
+    scope.provider('counter', counter, ttl=10)
+    with scope():
+        assert rw.scope.get('counter') == 1
+        assert rw.scope.get('counter') == 1
+        now[0] += 11
+        assert rw.scope.get('counter') == 2
+    # ttl values are not stored inside the scope
+    assert 'counter' not in scope
+
+
+class AsyncProviderTest(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    def test_coroutine_provider(self):
+        calls = []
+
+        @tornado.gen.coroutine
+        def load_user():
+            calls.append(1)
+            yield tornado.gen.moment
+            raise tornado.gen.Return('joe')
+
+        @rw.scope.inject
+        def page(user):
+            return 'hello ' + user
+
+        @tornado.gen.coroutine
+        def check():
+            # nothing is run before the value is needed
+            assert calls == []
+            future = rw.scope.get('user')
+            assert rw.scope.is_provided_future(future)
+            assert rw.scope.get('user') is future
+            assert (yield future) == 'joe'
+
+            # route functions get the result injected
+            plan = rw.routing.CallPlan(page, ())
+            assert (yield plan({})) == 'hello joe'
+
+        scope = rw.scope.Scope()
+        scope.provider('user', load_user)
+        yield scope.run(check)
+        assert calls == [1]
+
+    @tornado.testing.gen_test
+    def test_coroutine_provider_failure(self):
+        calls = []
+
+        @tornado.gen.coroutine
+        def connect():
+            calls.append(1)
+            yield tornado.gen.moment
+            if len(calls) == 1:
+                raise ValueError('db down')
+            raise tornado.gen.Return('connection')
+
+        @tornado.gen.coroutine
+        def check():
+            with pytest.raises(ValueError):
+                yield rw.scope.get('db')
+            # the provider is run again after a failure
+            assert (yield rw.scope.get('db')) == 'connection'
+            assert (yield rw.scope.get('db')) == 'connection'
+
+        scope = rw.scope.Scope()
+        scope.provider('db', connect)
+        yield scope.run(check)
+        assert calls == [1, 1]
+
+    @tornado.testing.gen_test
+    def test_coroutine_provider_middleware(self):
+        @tornado.gen.coroutine
+        def anonymous():
+            yield tornado.gen.moment
+            raise tornado.gen.Return(None)
+
+        @rw.scope.inject
+        def require_user(call_next, user):
+            if user is None:
+                raise tornado.web.HTTPError(403)
+            return call_next()
+
+        @tornado.gen.coroutine
+        def check():
+            with pytest.raises(tornado.web.HTTPError):
+                yield rw.routing.run_middleware((require_user,), lambda: 'admin area')
+
+        scope = rw.scope.Scope()
+        scope.provider('user', anonymous)
+        yield scope.run(check)
+
+
+def test_request_scope():
+    app_scope = rw.scope.Scope()
+    app_scope['settings'] = {}
+    app_scope['handler'] = 'app handler'
+    request_scope = rw.scope.RequestScope()
+
+    with app_scope():
+        with request_scope():
+            assert rw.scope.get('handler') == 'app handler'
+            request_scope['handler'] = 'request handler'
+            request_scope['extra'] = 1
+            request_scope.provider('user', lambda: 'joe')
+            assert rw.scope.get('handler') == 'request handler'
+            assert rw.scope.get('extra') == 1
+            assert rw.scope.get('user') == 'joe'
+            assert rw.scope.get('settings') == {}
+            assert rw.scope.get('scope') is request_scope
+            del request_scope['handler']
+            assert rw.scope.get('handler') == 'app handler'
+
+    with pytest.raises(AttributeError):
+        request_scope.some_attribute = True